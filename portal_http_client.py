@@ -0,0 +1,347 @@
+"""
+Browserless client for the Precision Agri-Lab portal
+Speaks the ASP.NET WebForms postback protocol directly over HTTP, so a run
+needs no browser: log in, set the date range, read the water reports grid
+and download the selected reports.
+"""
+
+import re
+from html.parser import HTMLParser
+from pathlib import PureWindowsPath
+from urllib.parse import urljoin, unquote
+import requests
+
+
+GRID_ID = 'ContentPlaceHolder1_portalContent_grdWaterReports'
+START_DATE_ID = 'ContentPlaceHolder1_portalContent_txtStartDate'
+END_DATE_ID = 'ContentPlaceHolder1_portalContent_txtEndDate'
+UPDATE_BUTTON_ID = 'ContentPlaceHolder1_portalContent_btnSubmitDateChanges'
+DOWNLOAD_BUTTON_ID = 'ContentPlaceHolder1_portalContent_btnDownloadSelectedWater'
+
+USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+)
+
+
+class PortalStructureError(Exception):
+    """Raised when a portal page does not look like what the HTTP client expects"""
+
+
+class PortalPageParser(HTMLParser):
+    """Collects the form fields, links and water reports grid rows of a portal page"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.form_action = None
+        self.inputs = []  # List of dicts with the attributes of every form control
+        self.links = []  # List of (href, id, text) tuples
+        self.grid_found = False
+        self.grid_rows = []  # List of dicts shaped like the browser grid snapshot
+        self.grid_headers = []  # Texts of the grid's <th> cells
+        self._select = None
+        self._textarea = None
+        self._link = None
+        self._grid_depth = 0
+        self._row = None
+        self._cell = None
+        self._header_row = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: (value if value is not None else '') for name, value in attrs}
+
+        if tag == 'form' and self.form_action is None:
+            self.form_action = attrs.get('action', '')
+        elif tag == 'input':
+            self.inputs.append(attrs)
+            if self._row is not None and 'chkWater' in attrs.get('id', ''):
+                self._row['checkbox_id'] = attrs.get('id')
+                self._row['checkbox_name'] = attrs.get('name')
+                self._row['checked'] = 'checked' in attrs
+        elif tag == 'select':
+            self._select = {'type': 'select', 'name': attrs.get('name', ''), 'id': attrs.get('id', ''), 'value': None}
+            self.inputs.append(self._select)
+        elif tag == 'option' and self._select is not None:
+            value = attrs.get('value', '')
+            if self._select['value'] is None or 'selected' in attrs:
+                self._select['value'] = value
+        elif tag == 'textarea':
+            self._textarea = {'type': 'textarea', 'name': attrs.get('name', ''), 'id': attrs.get('id', ''), 'value': ''}
+            self.inputs.append(self._textarea)
+        elif tag == 'a':
+            self._link = [attrs.get('href', ''), attrs.get('id', ''), '']
+
+        if tag == 'table' and attrs.get('id') == GRID_ID:
+            self.grid_found = True
+            self._grid_depth = 1
+        elif tag == 'table' and self._grid_depth:
+            self._grid_depth += 1
+        elif self._grid_depth == 1:
+            if tag == 'tr':
+                self._row = {'cells': [], 'checkbox_id': None, 'checkbox_name': None, 'checked': False, 'status': None}
+                self._header_row = False
+            elif tag == 'th' and self._row is not None:
+                self._header_row = True
+                self._cell = []
+            elif tag == 'td' and self._row is not None:
+                self._cell = []
+        if tag == 'br' and self._cell is not None:
+            self._cell.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag == 'select':
+            self._select = None
+        elif tag == 'textarea':
+            self._textarea = None
+        elif tag == 'a' and self._link is not None:
+            self._link[2] = ' '.join(self._link[2].split())
+            self.links.append(tuple(self._link))
+            self._link = None
+
+        if tag == 'table' and self._grid_depth:
+            self._grid_depth -= 1
+        elif self._grid_depth == 1:
+            if tag in ('td', 'th') and self._cell is not None and self._row is not None:
+                text = ' '.join(''.join(self._cell).split())
+                if tag == 'th':
+                    self.grid_headers.append(text)
+                else:
+                    self._row['cells'].append(text)
+                self._cell = None
+            elif tag == 'tr' and self._row is not None:
+                # Header rows (th) are only part of tbody in some GridView renderings
+                if not self._header_row:
+                    self._finish_row(self._row)
+                self._row = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+        if self._link is not None:
+            self._link[2] += data
+        if self._textarea is not None:
+            self._textarea['value'] += data
+
+    def _finish_row(self, row):
+        for text in row['cells']:
+            lower = text.lower()
+            if lower in ('water', 'in progress'):
+                row['status'] = lower
+                break
+        row['index'] = len(self.grid_rows)
+        row['text'] = '\t'.join(row['cells'])
+        self.grid_rows.append(row)
+
+
+class PortalPage:
+    """A parsed portal page together with the URL it was served from"""
+
+    def __init__(self, url, html):
+        self.url = url
+        self.html = html
+        self.parser = PortalPageParser()
+        self.parser.feed(html)
+        self.parser.close()
+
+    @property
+    def is_login_page(self):
+        return any(control.get('type', '').lower() == 'password' for control in self.parser.inputs)
+
+    def find_input(self, element_id=None, name_contains=None, input_type=None):
+        """Return the first form control matching the given id / name fragment / type"""
+        for control in self.parser.inputs:
+            if element_id and control.get('id') != element_id:
+                continue
+            if name_contains and name_contains.lower() not in control.get('name', '').lower():
+                continue
+            if input_type and control.get('type', 'text').lower() != input_type:
+                continue
+            return control
+        return None
+
+    def require_input(self, element_id):
+        """Like find_input, but a missing control means the page layout has changed"""
+        control = self.find_input(element_id=element_id)
+        if control is None or not control.get('name'):
+            raise PortalStructureError(f"Expected form field #{element_id} not found on {self.url}")
+        return control
+
+    def form_fields(self, submit=None, overrides=None):
+        """Build the POST body a browser would send for this page's form
+
+        Includes hidden fields (__VIEWSTATE, __EVENTVALIDATION, ...), text values,
+        checked checkboxes/radios and selects. Only the clicked submit button is sent.
+        """
+        if self.parser.form_action is None or self.find_input(element_id='__VIEWSTATE') is None:
+            raise PortalStructureError(f"No ASP.NET form with __VIEWSTATE on {self.url}")
+
+        fields = {}
+        for control in self.parser.inputs:
+            name = control.get('name')
+            if not name:
+                continue
+            control_type = control.get('type', 'text').lower()
+            if control_type in ('submit', 'button', 'image', 'reset', 'file'):
+                continue
+            if control_type in ('checkbox', 'radio'):
+                if 'checked' in control:
+                    fields[name] = control.get('value') or 'on'
+                continue
+            fields[name] = control.get('value') or ''
+
+        if submit is not None:
+            fields[submit['name']] = submit.get('value', '')
+        if overrides:
+            fields.update(overrides)
+        return fields
+
+    @property
+    def action_url(self):
+        return urljoin(self.url, self.parser.form_action or '')
+
+
+class PortalHttpClient:
+    """Drives the portal's login, date-range and Download Selected postbacks over HTTP"""
+
+    def __init__(self, portal_url, username, password, session=None, timeout=60):
+        self.portal_url = portal_url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.session.headers.setdefault('User-Agent', USER_AGENT)
+        self.page = None
+
+    def _load(self, response):
+        if response.status_code != 200:
+            raise PortalStructureError(f"HTTP {response.status_code} from {response.url}")
+        self.page = PortalPage(response.url, response.text)
+        return self.page
+
+    def _get(self, url):
+        return self._load(self.session.get(url, timeout=self.timeout))
+
+    def _post(self, page, fields, stream=False):
+        return self.session.post(page.action_url, data=fields, timeout=self.timeout, stream=stream)
+
+    def login(self):
+        """Log in with the portal credentials, leaving the landing page in self.page"""
+        # A pooled session may still hold cookies from an earlier login
+        self.session.cookies.clear()
+        page = self._get(self.portal_url)
+
+        username_field = page.find_input(name_contains='UserName') or page.find_input(input_type='text')
+        password_field = page.find_input(name_contains='Password') or page.find_input(input_type='password')
+        submit = page.find_input(input_type='submit')
+        if username_field is None or password_field is None or submit is None:
+            raise PortalStructureError("Login form fields not found")
+
+        fields = page.form_fields(submit=submit, overrides={
+            username_field['name']: self.username,
+            password_field['name']: self.password
+        })
+        page = self._load(self._post(page, fields))
+
+        if page.is_login_page:
+            raise PermissionError("Portal login rejected (still on the login page)")
+        return page
+
+    def open_water_reports(self):
+        """Follow the 'View All Reports' link to the page that holds the water grid"""
+        page = self.page
+        if page.find_input(element_id=START_DATE_ID) is not None:
+            return page
+
+        for href, link_id, text in page.parser.links:
+            if 'view all' not in text.lower():
+                continue
+            postback = re.match(r"javascript:__doPostBack\('([^']*)','([^']*)'\)", unquote(href))
+            if postback:
+                fields = page.form_fields(overrides={
+                    '__EVENTTARGET': postback.group(1),
+                    '__EVENTARGUMENT': postback.group(2)
+                })
+                page = self._load(self._post(page, fields))
+            else:
+                page = self._get(urljoin(page.url, href))
+            break
+
+        page.require_input(START_DATE_ID)
+        return page
+
+    def set_date_range(self, start_date, end_date):
+        """Post the 'Update Date Range' button and return the refreshed grid rows"""
+        page = self.page
+        start_field = page.require_input(START_DATE_ID)
+        end_field = page.require_input(END_DATE_ID)
+        update_button = page.require_input(UPDATE_BUTTON_ID)
+
+        fields = page.form_fields(submit=update_button, overrides={
+            start_field['name']: start_date,
+            end_field['name']: end_date
+        })
+        page = self._load(self._post(page, fields))
+        return self.grid_rows()
+
+    def grid_rows(self):
+        """Rows of the water reports grid on the current page"""
+        if not self.page.parser.grid_found:
+            # The grid is not rendered at all when there are no reports in some layouts
+            if 'no water reports found' in self.page.html.lower():
+                return []
+            raise PortalStructureError(f"Water reports grid #{GRID_ID} not found")
+        return self.page.parser.grid_rows
+
+    def grid_headers(self):
+        """Column header texts of the water reports grid on the current page"""
+        return self.page.parser.grid_headers
+
+    def download_selected(self, rows):
+        """Post Download Selected with the given rows ticked
+
+        Returns the streaming response and the filename from Content-Disposition.
+        The caller is responsible for consuming and closing the response.
+        """
+        page = self.page
+        download_button = page.require_input(DOWNLOAD_BUTTON_ID)
+
+        # Start from the page state, untick everything, then tick only the wanted rows
+        fields = page.form_fields(submit=download_button)
+        for row in page.parser.grid_rows:
+            if row.get('checkbox_name'):
+                fields.pop(row['checkbox_name'], None)
+        for row in rows:
+            if not row.get('checkbox_name'):
+                raise PortalStructureError(f"Row {row.get('index', 0) + 1} has no checkbox field name")
+            fields[row['checkbox_name']] = 'on'
+
+        response = self._post(page, fields, stream=True)
+        content_type = response.headers.get('Content-Type', '').lower()
+        disposition = response.headers.get('Content-Disposition', '')
+        if response.status_code != 200 or ('text/html' in content_type and 'attachment' not in disposition.lower()):
+            response.close()
+            raise PortalStructureError(
+                f"Download Selected did not return a file (HTTP {response.status_code}, {content_type or 'no content type'})"
+            )
+
+        filename = safe_filename(_filename_from_disposition(disposition), 'WaterReports.zip')
+        return response, filename
+
+
+def safe_filename(name, default):
+    """A server-supplied file name reduced to a plain name that can't leave its folder"""
+    # PureWindowsPath splits on both / and \, so '..\x' and '../x' both end up as 'x'
+    name = PureWindowsPath(name or '').name
+    name = re.sub(r'[\x00-\x1f<>:"|?*]', '_', name).strip(' .')
+    return name or default
+
+
+def _filename_from_disposition(disposition):
+    """Extract the filename from a Content-Disposition header"""
+    match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", disposition, re.IGNORECASE)
+    if match:
+        return unquote(match.group(1).strip().strip('"'))
+    match = re.search(r'filename="?([^";]+)"?', disposition, re.IGNORECASE)
+    if match:
+        return match.group(1).strip()
+    return None
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Check QuickXorHash against a known quickXorHash value
+The unchanged-in-SharePoint check compares this hash with Graph's, so a broken
+or missing hasher means every existing file is re-uploaded or errors out.
+"""
+
+import tempfile
+from pathlib import Path
+
+from water_report_automation import QuickXorHash
+
+KNOWN_VECTOR = (b'hello world', 'aCgDG9jwBhDc4Q1yawMZAAAAAAA=')
+
+
+def test_quick_xor_hash():
+    """Hash the known vector in one block, split across updates, and from a file"""
+    data, expected = KNOWN_VECTOR
+
+    hasher = QuickXorHash()
+    hasher.update(data)
+    assert hasher.b64digest() == expected
+
+    hasher = QuickXorHash()
+    hasher.update(data[:6])
+    hasher.update(data[6:])
+    assert hasher.b64digest() == expected
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'vector.bin'
+        path.write_bytes(data)
+        assert QuickXorHash.of_file(path, block_size=4) == expected
+
+    print(f"✓ quickXorHash of {data!r} is {expected}")
+
+
+if __name__ == "__main__":
+    test_quick_xor_hash()
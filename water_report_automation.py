@@ -7,35 +7,1555 @@ Automates downloading water reports from Precision Agri-Lab portal and uploading
 import os
 import sys
 import re
+import io
+import json
+import time
+import base64
+import hashlib
 from datetime import datetime, timedelta
 from pathlib import Path
 import asyncio
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib.parse import urlparse
+import threading
 
 # Load environment variables
 load_dotenv()
 
+# Water reports grid on the "View All Reports" page
+GRID_SELECTOR = '#ContentPlaceHolder1_portalContent_grdWaterReports'
+
+# Collects every grid row in a single browser round trip. Returns the header
+# texts plus one plain object per <tbody> row so Python never has to touch the
+# DOM cell by cell.
+GRID_SNAPSHOT_JS = """
+(tableSelector) => {
+    const table = document.querySelector(tableSelector);
+    if (!table) {
+        return null;
+    }
+    const headers = Array.from(table.querySelectorAll('th')).map(
+        (cell) => (cell.innerText || '').trim()
+    );
+    const rows = Array.from(table.querySelectorAll('tbody tr'));
+    return { headers: headers, rows: rows.map((row, index) => {
+        const cells = Array.from(row.querySelectorAll('td')).map(
+            (cell) => (cell.innerText || '').trim()
+        );
+        const checkbox = row.querySelector('input[id*="chkWater"]');
+        let status = null;
+        for (const text of cells) {
+            const lower = text.toLowerCase();
+            if (lower === 'water' || lower === 'in progress') {
+                status = lower;
+                break;
+            }
+        }
+        return {
+            index: index,
+            cells: cells,
+            checkbox_id: checkbox ? checkbox.id : null,
+            checkbox_name: checkbox ? checkbox.name : null,
+            checked: checkbox ? checkbox.checked : false,
+            status: status,
+            text: (row.innerText || '').trim()
+        };
+    }) };
+}
+"""
+
+
+# Grid column headers that hold a report's identifier, in order of preference.
+# REPORT_ID_COLUMN in .env overrides them with an exact header name.
+REPORT_ID_HEADERS = ['lab number', 'lab no', 'lab #', 'sample id', 'sample number', 'sample #', 'report id']
+
+
+def report_id_for_row(headers, cells):
+    """Identify a grid row by its lab number / sample id column
+    
+    Falls back to a hash of the row's cells (minus the status cell) when no
+    identifier column can be found, so a row keeps its id when its status
+    moves from 'in progress' to 'water'.
+    """
+    def normalize(header):
+        return ' '.join(header.lower().replace('.', ' ').split())
+    
+    wanted = [normalize(os.getenv('REPORT_ID_COLUMN'))] if os.getenv('REPORT_ID_COLUMN') else REPORT_ID_HEADERS
+    normalized = [normalize(header) for header in headers]
+    for name in wanted:
+        if name in normalized:
+            column = normalized.index(name)
+            if column < len(cells) and cells[column]:
+                return cells[column]
+    
+    stable_cells = [cell for cell in cells if cell and cell.lower() not in ('water', 'in progress')]
+    if not stable_cells:
+        return None
+    return hashlib.sha1('\x1f'.join(stable_cells).encode('utf-8')).hexdigest()[:16]
+
+
+@dataclass
+class GridRow:
+    """A single row of the water reports grid, captured in one snapshot"""
+    index: int
+    cells: list = field(default_factory=list)
+    checkbox_id: str = None
+    checkbox_name: str = None
+    checked: bool = False
+    status: str = None
+    text: str = ''
+    report_id: str = None
+
+    @classmethod
+    def from_snapshot(cls, data, headers=None):
+        """Build a row record from one row dict returned by GRID_SNAPSHOT_JS"""
+        row = cls(
+            index=data.get('index', 0),
+            cells=list(data.get('cells') or []),
+            checkbox_id=data.get('checkbox_id'),
+            checkbox_name=data.get('checkbox_name'),
+            checked=bool(data.get('checked')),
+            status=data.get('status'),
+            text=data.get('text', '')
+        )
+        row.report_id = report_id_for_row(headers or [], row.cells)
+        return row
+
+    @property
+    def is_selectable(self):
+        """True when the row is a finished water report with a checkbox"""
+        return self.checkbox_id is not None and self.status == 'water'
+
+    @property
+    def checkbox_selector(self):
+        """Selector that targets this row's checkbox by its exact id"""
+        return f'[id="{self.checkbox_id}"]' if self.checkbox_id else None
+
+
+class GridPollState:
+    """What the water grid looked like at the last poll
+    
+    The fingerprint covers every row's report id and status, so an unchanged
+    grid is detected without touching the ledger, the download or SharePoint.
+    """
+    
+    def __init__(self):
+        self.fingerprint = None
+        self.statuses = {}  # report_id -> status at the last successful poll
+    
+    @staticmethod
+    def fingerprint_of(rows):
+        digest = hashlib.sha1()
+        for line in sorted(f"{row.report_id}|{row.status}" for row in rows):
+            digest.update(line.encode('utf-8') + b'\n')
+        return digest.hexdigest()
+    
+    def changed_ids(self, rows):
+        """None if the grid is identical to the last poll, else the ids of rows
+        that are new or have just moved to 'water'"""
+        if self.fingerprint_of(rows) == self.fingerprint:
+            return None
+        return {
+            row.report_id for row in rows
+            if row.status == 'water' and self.statuses.get(row.report_id) != 'water'
+        }
+    
+    def update(self, rows):
+        """Remember the grid once its changes were handled"""
+        self.fingerprint = self.fingerprint_of(rows)
+        self.statuses = {row.report_id: row.status for row in rows if row.report_id}
+
+
+# Ticks the given checkboxes in place. Uses the element's own click() so every
+# handler the ASP.NET grid attached (click/input/change) fires as it would for a
+# user. Checkboxes with AutoPostBack are left for the caller to click one by one,
+# since each of those triggers a server round trip.
+BULK_SELECT_JS = """
+([tableSelector, ids]) => {
+    const table = document.querySelector(tableSelector);
+    const result = { changed: 0, autopostback: false, pending: [], missing: [] };
+    for (const id of ids) {
+        const checkbox = document.getElementById(id);
+        if (!checkbox || (table && !table.contains(checkbox))) {
+            result.missing.push(id);
+            continue;
+        }
+        if (checkbox.checked) {
+            continue;
+        }
+        const handler = checkbox.getAttribute('onclick') || '';
+        if (handler.indexOf('__doPostBack') !== -1) {
+            result.autopostback = true;
+            result.pending.push(id);
+            continue;
+        }
+        checkbox.click();
+        if (!checkbox.checked) {
+            checkbox.checked = true;
+            checkbox.dispatchEvent(new Event('change', { bubbles: true }));
+        }
+        result.changed += 1;
+    }
+    return result;
+}
+"""
+
+# Ids of every water checkbox currently checked in the grid
+SELECTED_IDS_JS = """
+(tableSelector) => {
+    const table = document.querySelector(tableSelector);
+    if (!table) {
+        return [];
+    }
+    return Array.from(table.querySelectorAll('input[id*="chkWater"]'))
+        .filter((checkbox) => checkbox.checked)
+        .map((checkbox) => checkbox.id);
+}
+"""
+
+# What the production browser profile never loads: nothing on the portal depends on them
+BLOCKED_RESOURCE_TYPES = {'image', 'font', 'media'}
+BLOCKED_DOMAINS = (
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net',
+    'clarity.ms', 'hotjar.com', 'facebook.net', 'newrelic.com', 'nr-data.net'
+)
+
+# Default budget (milliseconds) for each named portal wait. Any of them can be
+# overridden with an environment variable, e.g. WAIT_TIMEOUT_GRID_REFRESH=60000
+DEFAULT_WAIT_TIMEOUTS = {
+    'page_ready': 30000,
+    'postback': 30000,
+    'tabs': 15000,
+    'date_inputs': 15000,
+    'input_value': 5000,
+    'grid_refresh': 45000,
+}
+
+# True once the document has loaded and no ASP.NET AJAX postback is in flight
+POSTBACK_IDLE_JS = """
+() => {
+    if (document.readyState !== 'complete') {
+        return false;
+    }
+    if (window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager) {
+        const prm = Sys.WebForms.PageRequestManager.getInstance();
+        if (prm && prm.get_isInAsyncPostBack()) {
+            return false;
+        }
+    }
+    return true;
+}
+"""
+
+# Tags the current grid element so a later wait can tell when it was replaced
+GRID_MARK_JS = """
+([tableSelector, token]) => {
+    const table = document.querySelector(tableSelector);
+    if (table) {
+        table.setAttribute('data-wra-token', token);
+    }
+    return table !== null;
+}
+"""
+
+# True once the grid (or the page) has been re-rendered since GRID_MARK_JS ran
+GRID_REPLACED_JS = """
+([tableSelector, token]) => {
+    if (document.readyState !== 'complete') {
+        return false;
+    }
+    if (window.Sys && Sys.WebForms && Sys.WebForms.PageRequestManager) {
+        const prm = Sys.WebForms.PageRequestManager.getInstance();
+        if (prm && prm.get_isInAsyncPostBack()) {
+            return false;
+        }
+    }
+    const table = document.querySelector(tableSelector);
+    return table !== null && table.getAttribute('data-wra-token') !== token;
+}
+"""
+
+
+class PortalWaits:
+    """Condition-based waits for the portal, with per-wait timeouts and timings"""
+    
+    def __init__(self, timeouts=None):
+        self.timeouts = dict(DEFAULT_WAIT_TIMEOUTS)
+        for name in self.timeouts:
+            env_value = os.getenv(f'WAIT_TIMEOUT_{name.upper()}')
+            if env_value:
+                self.timeouts[name] = int(env_value)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.timings = []  # List of {'name', 'seconds', 'timeout_ms', 'ok'} records
+    
+    def timeout_for(self, name):
+        """Return the timeout in milliseconds configured for a named wait"""
+        return self.timeouts.get(name, DEFAULT_WAIT_TIMEOUTS['postback'])
+    
+    async def _timed(self, name, coro_factory):
+        """Run a wait, recording how long it actually took and whether it succeeded"""
+        timeout = self.timeout_for(name)
+        started = time.monotonic()
+        ok = False
+        try:
+            result = await coro_factory(timeout)
+            ok = True
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            self.timings.append({
+                'name': name,
+                'seconds': round(elapsed, 3),
+                'timeout_ms': timeout,
+                'ok': ok
+            })
+    
+    async def _poll_function(self, page, expression, arg, timeout):
+        """wait_for_function that survives the page being replaced by a full postback"""
+        deadline = time.monotonic() + timeout / 1000
+        while True:
+            remaining = max(int((deadline - time.monotonic()) * 1000), 1)
+            try:
+                return await page.wait_for_function(expression, arg=arg, timeout=remaining, polling=100)
+            except PlaywrightTimeout:
+                raise
+            except Exception as e:
+                # A full-page postback destroys the execution context mid-wait
+                if 'context was destroyed' not in str(e) or time.monotonic() >= deadline:
+                    raise
+                await page.wait_for_load_state('domcontentloaded', timeout=remaining)
+    
+    async def page_ready(self, page):
+        """Wait for the document to finish loading with no postback in flight"""
+        return await self._timed(
+            'page_ready',
+            lambda timeout: self._poll_function(page, POSTBACK_IDLE_JS, None, timeout)
+        )
+    
+    async def postback(self, page):
+        """Wait for the current ASP.NET postback (full or partial) to finish"""
+        return await self._timed(
+            'postback',
+            lambda timeout: self._poll_function(page, POSTBACK_IDLE_JS, None, timeout)
+        )
+    
+    async def selector(self, page, name, selector):
+        """Wait for an element to become visible, recorded under the given wait name"""
+        return await self._timed(
+            name,
+            lambda timeout: page.wait_for_selector(selector, state='visible', timeout=timeout)
+        )
+    
+    async def input_value(self, page, selector, value):
+        """Wait until an input actually holds the value that was filled in"""
+        return await self._timed(
+            'input_value',
+            lambda timeout: self._poll_function(
+                page,
+                "([sel, value]) => { const el = document.querySelector(sel); return el !== null && el.value === value; }",
+                [selector, value],
+                timeout
+            )
+        )
+    
+    async def grid_refresh(self, page, action):
+        """Run an action (e.g. a button click) and wait until the grid DOM is replaced"""
+        token = f"{time.time_ns()}"
+        async def run(timeout):
+            await page.evaluate(GRID_MARK_JS, [GRID_SELECTOR, token])
+            await action()
+            return await self._poll_function(page, GRID_REPLACED_JS, [GRID_SELECTOR, token], timeout)
+        return await self._timed('grid_refresh', run)
+    
+    def summary(self):
+        """Return a printable one-line-per-wait summary of recorded timings"""
+        lines = []
+        for timing in self.timings:
+            status = "ok" if timing['ok'] else "FAILED"
+            lines.append(
+                f"  {timing['name']}: {timing['seconds']:.2f}s "
+                f"(budget {timing['timeout_ms'] / 1000:.0f}s, {status})"
+            )
+        return "\n".join(lines)
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter that counts how many TCP/TLS connections its pools open"""
+    
+    def __init__(self, stats, lock, **kwargs):
+        self._stats = stats
+        self._lock = lock
+        super().__init__(**kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats, lock = self._stats, self._lock
+        
+        def counting(pool_class):
+            class CountingPool(pool_class):
+                def _new_conn(self):
+                    with lock:
+                        stats['new_connections'] += 1
+                    return super()._new_conn()
+            return CountingPool
+        
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': counting(HTTPConnectionPool),
+            'https': counting(HTTPSConnectionPool)
+        }
+
+
+class PooledSession(requests.Session):
+    """requests.Session with keep-alive pools, a default timeout and reuse counters"""
+    
+    def __init__(self, pool_size=10, timeout=(10, 60)):
+        super().__init__()
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'new_connections': 0}
+        adapter = _CountingAdapter(self.stats, self._lock, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+    
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self.stats['requests'] += 1
+        return super().request(method, url, **kwargs)
+    
+    @property
+    def reused_connections(self):
+        return max(self.stats['requests'] - self.stats['new_connections'], 0)
+
+
+class HttpPools:
+    """Named, shared HTTP sessions (one keep-alive pool per remote service)
+    
+    'graph' is used for every Microsoft Graph call (SharePoint upload and mail),
+    'portal' for the browserless portal client. Pool size and timeouts come from
+    HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT.
+    """
+    
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.pool_size = pool_size or int(os.getenv('HTTP_POOL_SIZE', '10'))
+        self.timeout = (
+            connect_timeout or float(os.getenv('HTTP_CONNECT_TIMEOUT', '10')),
+            read_timeout or float(os.getenv('HTTP_READ_TIMEOUT', '60'))
+        )
+        self._sessions = {}
+        self._lock = threading.Lock()
+    
+    def session(self, name):
+        """Return the shared session for a service, creating it on first use"""
+        with self._lock:
+            if name not in self._sessions:
+                self._sessions[name] = PooledSession(self.pool_size, self.timeout)
+            return self._sessions[name]
+    
+    def summary(self):
+        """Printable per-pool request / new-connection / reuse counters"""
+        lines = []
+        for name, session in sorted(self._sessions.items()):
+            lines.append(
+                f"  {name}: {session.stats['requests']} request(s), "
+                f"{session.stats['new_connections']} new connection(s), "
+                f"{session.reused_connections} reused"
+            )
+        return "\n".join(lines)
+    
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+# Process-wide pools, shared by every WaterReportAutomation instance
+HTTP_POOLS = HttpPools()
+
+
+class GraphScheduler:
+    """Shared front door for Graph/SharePoint calls that copes with throttling
+    
+    Every call takes a token from one token bucket (GRAPH_RATE_PER_SECOND,
+    GRAPH_BURST) and a slot from an adaptive concurrency limit. A 429/503 makes
+    every worker pause for the Retry-After period and halves the concurrency
+    limit; a run of successes raises it again, one slot at a time. Other
+    transient failures (5xx, request errors) of idempotent calls are retried
+    with jittered exponential backoff. Time spent waiting is kept in stats.
+    """
+    
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'}
+    
+    def __init__(self, session, rate=None, burst=None, max_concurrency=None, max_retries=None):
+        self.session = session
+        self.rate = rate or float(os.getenv('GRAPH_RATE_PER_SECOND', '10'))
+        self.burst = burst or float(os.getenv('GRAPH_BURST', '20'))
+        self.max_concurrency = max_concurrency or int(os.getenv('GRAPH_MAX_CONCURRENCY', '8'))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('GRAPH_MAX_RETRIES', '5'))
+        self.limit = self.max_concurrency
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'throttled': 0,
+            'throttled_seconds': 0.0,
+            'rate_limited_seconds': 0.0,
+            'min_limit': self.limit
+        }
+    
+    def _acquire(self):
+        """Wait for a concurrency slot, the end of any throttling pause, and a token"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                    continue
+                if self._active >= self.limit:
+                    self._cond.wait(0.5)
+                    continue
+                
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+                if self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                    self._cond.wait(wait)
+                    self.stats['rate_limited_seconds'] += time.monotonic() - now
+                    continue
+                
+                self._tokens -= 1
+                self._active += 1
+                self.stats['requests'] += 1
+                return
+    
+    def _release(self, throttled_for=None):
+        with self._cond:
+            self._active -= 1
+            if throttled_for is not None:
+                # Back off as a group: everyone pauses and the concurrency limit halves
+                self.stats['throttled'] += 1
+                now = time.monotonic()
+                paused_until = now + throttled_for
+                if paused_until > self._paused_until:
+                    # Count wall-clock pause time once, not once per waiting thread
+                    self.stats['throttled_seconds'] += paused_until - max(self._paused_until, now)
+                    self._paused_until = paused_until
+                self.limit = max(1, self.limit // 2)
+                self.stats['min_limit'] = min(self.stats['min_limit'], self.limit)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= 10 and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+    
+    @staticmethod
+    def _retry_after(response, attempt):
+        """Seconds to wait: the server's Retry-After if given, else jittered exponential backoff"""
+        import random
+        
+        header = response.headers.get('Retry-After') if response is not None else None
+        if header:
+            try:
+                return max(float(header), 0.0)
+            except ValueError:
+                pass
+        return min(2 ** attempt, 60) * (0.5 + random.random() / 2)
+    
+    def request(self, method, url, idempotent=None, **kwargs):
+        """Send a request, retrying throttled and transient failures
+        
+        Only idempotent calls are retried after a timeout or 5xx. POSTs, and calls
+        marked idempotent=False (upload-session chunks), are only resent after a
+        429/503 with Retry-After, which means the server did not process them.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            response = None
+            throttled_for = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if idempotent:
+                    retryable = response.status_code in self.RETRY_STATUSES
+                else:
+                    retryable = response.status_code in (429, 503) and 'Retry-After' in response.headers
+                if not retryable or attempt == self.max_retries:
+                    return response
+                delay = self._retry_after(response, attempt)
+                if response.status_code in (429, 503):
+                    throttled_for = delay
+            except requests.RequestException:
+                if attempt == self.max_retries or not idempotent:
+                    raise
+                delay = self._retry_after(None, attempt)
+            finally:
+                # The slot goes back whatever happened, or later calls would wait in _acquire forever
+                self._release(throttled_for=throttled_for)
+            
+            self.stats['retries'] += 1
+            if throttled_for is None:
+                time.sleep(delay)
+        return response
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+    
+    def summary(self):
+        return (
+            f"  graph scheduler: {self.stats['requests']} call(s), {self.stats['retries']} retried, "
+            f"{self.stats['throttled']} throttled, {self.stats['throttled_seconds']:.1f}s paused by throttling, "
+            f"{self.stats['rate_limited_seconds']:.1f}s waiting on the rate limit, "
+            f"concurrency limit {self.limit} (lowest {self.stats['min_limit']})"
+        )
+
+
+_graph_schedulers = {}
+_graph_scheduler_lock = threading.Lock()
+
+
+def get_graph_scheduler(tenant_id=None):
+    """Process-wide GraphScheduler for a tenant, over the shared 'graph' HTTP pool
+    
+    Graph throttles per tenant, so accounts in the same tenant share one
+    scheduler (and its adaptive limits) while other tenants get their own.
+    """
+    key = tenant_id or os.getenv('SHAREPOINT_TENANT_ID') or 'default'
+    with _graph_scheduler_lock:
+        if key not in _graph_schedulers:
+            _graph_schedulers[key] = GraphScheduler(HTTP_POOLS.session('graph'))
+        return _graph_schedulers[key]
+
+
+async def launch_browser(playwright, profile=None):
+    """Launch the browser used for portal sessions, as configured by BROWSER_PROFILE"""
+    profile = profile or os.getenv('BROWSER_PROFILE', 'production').lower()
+    if profile == 'debug':
+        # Launch browser - using system Chrome instead of Chromium
+        return await playwright.chromium.launch(
+            channel='chrome',  # Use system Chrome browser
+            headless=False,  # Running with visible browser
+            slow_mo=100,  # Slow enough to follow along
+            args=['--start-maximized']  # Launch in maximized window
+        )
+    
+    # Production: bundled headless Chromium, no desktop session needed
+    return await playwright.chromium.launch(headless=True)
+
+
+class SessionStore:
+    """Encrypted on-disk copy of the authenticated Playwright storage state
+    
+    The state (cookies plus the ASP.NET session) is encrypted with Fernet. The key
+    comes from SESSION_ENCRYPTION_KEY, or is derived from the portal credentials
+    when that is not set, so the file is useless without the .env it came from.
+    """
+    
+    def __init__(self, path, username, password, key=None, max_age_hours=12):
+        self.path = Path(path)
+        self.max_age_hours = max_age_hours
+        self._fernet = None
+        
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            print("cryptography library not installed, session reuse disabled. Run: pip install cryptography")
+            return
+        
+        if not key:
+            if not username or not password:
+                return
+            salt = f"water-report-session:{username}".encode('utf-8')
+            raw_key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 200000)
+            key = base64.urlsafe_b64encode(raw_key)
+        try:
+            self._fernet = Fernet(key)
+        except (ValueError, TypeError) as e:
+            # A malformed key must not stop the run; it just can't reuse sessions
+            print(f"Warning: SESSION_ENCRYPTION_KEY is not a valid Fernet key ({e}), session reuse disabled")
+    
+    @property
+    def enabled(self):
+        return self._fernet is not None
+    
+    def load(self):
+        """Return the saved session ({'storage_state', 'landing_url', 'saved_at'}) or None"""
+        if not self.enabled or not self.path.exists():
+            return None
+        try:
+            payload = json.loads(self._fernet.decrypt(self.path.read_bytes()))
+        except Exception as e:
+            print(f"Ignoring unreadable saved session: {e}")
+            self.clear()
+            return None
+        
+        saved_at = datetime.fromisoformat(payload.get('saved_at'))
+        if datetime.now() - saved_at > timedelta(hours=self.max_age_hours):
+            print("Saved session is too old, a fresh login is needed")
+            self.clear()
+            return None
+        return payload
+    
+    def save(self, storage_state, landing_url):
+        """Encrypt and write the storage state of a logged-in context"""
+        if not self.enabled:
+            return
+        payload = {
+            'storage_state': storage_state,
+            'landing_url': landing_url,
+            'saved_at': datetime.now().isoformat()
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        temp_path.write_bytes(self._fernet.encrypt(json.dumps(payload).encode('utf-8')))
+        os.chmod(temp_path, 0o600)
+        temp_path.replace(self.path)
+    
+    def clear(self):
+        """Forget the saved session"""
+        if self.path.exists():
+            self.path.unlink()
+
+
+class ReportLedger:
+    """Local SQLite record of processed reports plus the last-successful-date watermark"""
+    
+    def __init__(self, path):
+        import sqlite3
+        
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_reports ("
+            " report_id TEXT PRIMARY KEY,"
+            " run_date TEXT,"
+            " processed_at TEXT NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL)"
+        )
+        self.conn.commit()
+    
+    def processed_ids(self, report_ids):
+        """Return the subset of report_ids that are already in the ledger"""
+        found = set()
+        report_ids = list(report_ids)
+        # Stay well under SQLite's bound-parameter limit
+        for start in range(0, len(report_ids), 500):
+            chunk = report_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT report_id FROM processed_reports WHERE report_id IN ({placeholders})",
+                chunk
+            ).fetchall()
+            found.update(row[0] for row in rows)
+        return found
+    
+    def mark_processed(self, report_ids, run_date=None):
+        """Add report ids to the ledger"""
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO processed_reports (report_id, run_date, processed_at) VALUES (?, ?, ?)",
+                [(report_id, run_date, now) for report_id in report_ids]
+            )
+    
+    def get_watermark(self):
+        """Return the end date (YYYY-MM-DD) of the last successful run, or None"""
+        row = self.conn.execute("SELECT value FROM sync_state WHERE key = 'watermark'").fetchone()
+        return row[0] if row else None
+    
+    def set_watermark(self, date_str):
+        """Move the watermark forward (it never moves backwards)"""
+        current = self.get_watermark()
+        if current and current >= date_str:
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('watermark', ?)",
+                (date_str,)
+            )
+    
+    def close(self):
+        self.conn.close()
+
+
+class JsonStore:
+    """Small thread-safe JSON file of keyed entries, used for local caches"""
+    
+    _locks = {}  # One lock per file, shared by every store instance pointing at it
+    _locks_guard = threading.Lock()
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        with JsonStore._locks_guard:
+            self._lock = JsonStore._locks.setdefault(str(self.path.resolve()), threading.Lock())
+    
+    def _read(self):
+        if not self.path.exists():
+            return {}
+        try:
+            return json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+    
+    def _write(self, entries):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(f'.{threading.get_ident()}.tmp')
+        temp_path.write_text(json.dumps(entries, indent=2), encoding='utf-8')
+        temp_path.replace(self.path)
+    
+    def put(self, key, entry):
+        with self._lock:
+            entries = self._read()
+            entries[key] = entry
+            self._write(entries)
+    
+    def remove(self, key):
+        with self._lock:
+            entries = self._read()
+            if entries.pop(key, None) is not None:
+                self._write(entries)
+
+
+class UploadSessionStore(JsonStore):
+    """Saved Graph upload sessions, so an interrupted large upload can resume
+    
+    Entries are keyed by target path and file content hash and hold the session
+    URL, its expiry and the next byte Graph expects.
+    """
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._read().get(key)
+        if entry and entry.get('expires'):
+            expires = datetime.fromisoformat(entry['expires'].replace('Z', '+00:00'))
+            if expires <= datetime.now(expires.tzinfo) + timedelta(minutes=1):
+                self.remove(key)
+                return None
+        return entry
+
+
+class SharePointIdCache(JsonStore):
+    """Resolved site, drive and folder item ids for a SharePoint target, with a TTL"""
+    
+    def __init__(self, path, ttl_hours=24):
+        super().__init__(path)
+        self.ttl = timedelta(hours=ttl_hours)
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._read().get(key)
+        if entry and datetime.now() - datetime.fromisoformat(entry['resolved_at']) < self.ttl:
+            return entry
+        return None
+
+
+class GraphTokenProvider:
+    """Process-wide Microsoft Graph token source backed by a serialized MSAL cache
+    
+    One provider exists per (tenant, client id). A token is handed out until
+    GRAPH_TOKEN_MIN_TTL seconds before it expires, and a background timer
+    fetches the next one GRAPH_TOKEN_REFRESH_AHEAD seconds before that, so callers
+    normally never wait on Azure AD. acquire() is thread-safe; async code can
+    use acquire_async().
+    """
+    
+    _providers = {}
+    _registry_lock = threading.Lock()
+    
+    def __init__(self, tenant_id, client_id, client_secret, cache_path=None):
+        import msal
+        
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        cache_dir = Path(os.getenv('GRAPH_TOKEN_CACHE_DIR', './.state'))
+        self.cache_path = Path(cache_path) if cache_path else cache_dir / f"graph_token_cache_{tenant_id}_{client_id}.json"
+        self.min_ttl = int(os.getenv('GRAPH_TOKEN_MIN_TTL', '120'))
+        self.refresh_ahead = int(os.getenv('GRAPH_TOKEN_REFRESH_AHEAD', '300'))
+        self.scopes = ["https://graph.microsoft.com/.default"]
+        self._lock = threading.RLock()
+        self._result = None
+        self._expires_at = 0.0
+        self._timer = None
+        
+        self.cache = msal.SerializableTokenCache()
+        if self.cache_path.exists():
+            try:
+                self.cache.deserialize(self.cache_path.read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                print("Ignoring unreadable Graph token cache")
+        
+        # Authenticate using MSAL
+        self.app = msal.ConfidentialClientApplication(
+            client_id,
+            authority=f"https://login.microsoftonline.com/{tenant_id}",
+            client_credential=client_secret,
+            token_cache=self.cache
+        )
+    
+    @classmethod
+    def for_credentials(cls, tenant_id, client_id, client_secret):
+        """Return the shared provider for these app credentials, creating it once"""
+        key = (tenant_id, client_id)
+        with cls._registry_lock:
+            if key not in cls._providers:
+                cls._providers[key] = cls(tenant_id, client_id, client_secret)
+            return cls._providers[key]
+    
+    def acquire(self):
+        """Return an MSAL result dict with a token valid for at least min_ttl seconds"""
+        with self._lock:
+            if self._result and time.time() < self._expires_at - self.min_ttl:
+                return self._result
+            return self._fetch()
+    
+    async def acquire_async(self):
+        """acquire() for coroutines, run off the event loop"""
+        return await asyncio.to_thread(self.acquire)
+    
+    def _fetch(self):
+        """Get a token from the MSAL cache or Azure AD and schedule the next refresh"""
+        with self._lock:
+            # MSAL serves a still-valid token from its cache and only calls Azure AD when needed
+            result = self.app.acquire_token_for_client(scopes=self.scopes)
+            if "access_token" not in result:
+                return result
+            
+            self._result = result
+            self._expires_at = time.time() + int(result.get('expires_in', 0))
+            self._save_cache()
+            self._schedule_refresh()
+            return result
+    
+    def _save_cache(self):
+        if not self.cache.has_state_changed:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.cache_path.with_suffix('.tmp')
+        temp_path.write_text(self.cache.serialize(), encoding='utf-8')
+        os.chmod(temp_path, 0o600)
+        temp_path.replace(self.cache_path)
+        self.cache.has_state_changed = False
+    
+    def _schedule_refresh(self):
+        if self._timer:
+            self._timer.cancel()
+        delay = self._expires_at - self.refresh_ahead - time.time()
+        if delay <= 0:
+            return
+        self._timer = threading.Timer(delay, self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+    
+    def _refresh_in_background(self):
+        try:
+            # Drop the cached token so MSAL fetches a new one rather than returning it again
+            with self._lock:
+                for token in self.cache.find(self.cache.CredentialType.ACCESS_TOKEN):
+                    self.cache.remove_at(token)
+                self._result = None
+                self._fetch()
+        except Exception as e:
+            print(f"Background Graph token refresh failed: {e}")
+
+
+class GraphBatch:
+    """Groups Graph calls into JSON $batch requests (at most 20 sub-requests each)
+    
+    Sub-requests that depend on each other (depends_on) are always sent in the
+    same batch, as Graph requires. execute() returns one
+    {'status', 'body', 'headers'} dict per request id, so failures can be handled
+    item by item.
+    """
+    
+    MAX_REQUESTS = 20
+    BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+    
+    def __init__(self):
+        self.requests = []
+    
+    def add(self, method, url, body=None, headers=None, depends_on=None):
+        """Queue a sub-request; url is relative to /v1.0 (e.g. '/drives/{id}/items/{id}')"""
+        request_id = str(len(self.requests) + 1)
+        request = {'id': request_id, 'method': method, 'url': url}
+        if body is not None:
+            request['body'] = body
+            request['headers'] = {'Content-Type': 'application/json', **(headers or {})}
+        elif headers:
+            request['headers'] = headers
+        if depends_on:
+            request['dependsOn'] = [depends_on] if isinstance(depends_on, str) else list(depends_on)
+        self.requests.append(request)
+        return request_id
+    
+    def _chunks(self):
+        """Split the queued requests into batches, keeping dependency chains together"""
+        # Union the request with every request it depends on, so a request with
+        # several dependencies merges all their chains into one group
+        parent = {}
+        
+        def root(request_id):
+            while parent[request_id] != request_id:
+                request_id = parent[request_id]
+            return request_id
+        
+        for request in self.requests:
+            parent[request['id']] = request['id']
+            for dependency in request.get('dependsOn', []):
+                if dependency in parent:
+                    parent[root(dependency)] = root(request['id'])
+        
+        grouped = {}
+        for request in self.requests:
+            grouped.setdefault(root(request['id']), []).append(request)
+        groups = list(grouped.values())
+        
+        chunks = [[]]
+        for group in groups:
+            if len(group) > self.MAX_REQUESTS:
+                raise ValueError(f"Dependency chain of {len(group)} requests does not fit in one batch")
+            if len(chunks[-1]) + len(group) > self.MAX_REQUESTS:
+                chunks.append([])
+            chunks[-1].extend(group)
+        return [chunk for chunk in chunks if chunk]
+    
+    def execute(self, graph, access_token, max_attempts=4):
+        """Send every queued request and return {request_id: response dict}
+        
+        Sub-requests that come back 429/503 are sent again in a later batch after
+        the longest Retry-After they were given.
+        """
+        results = {}
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        for attempt in range(max_attempts):
+            throttled = []
+            retry_after = 0.0
+            for chunk in self._chunks():
+                # A batch of GETs and PATCHes is as safe to resend as its parts
+                idempotent = all(request['method'] in graph.IDEMPOTENT_METHODS for request in chunk)
+                response = graph.post(self.BATCH_URL, idempotent=idempotent, headers=headers, json={'requests': chunk})
+                if response.status_code != 200:
+                    # The whole batch was rejected, report it against each of its items
+                    for request in chunk:
+                        results[request['id']] = {'status': response.status_code, 'body': response.text, 'headers': {}}
+                    continue
+                by_id = {request['id']: request for request in chunk}
+                for item in response.json().get('responses', []):
+                    results[item['id']] = {
+                        'status': item.get('status'),
+                        'body': item.get('body'),
+                        'headers': item.get('headers', {})
+                    }
+                    if item.get('status') in (429, 503) and item['id'] in by_id:
+                        throttled.append(by_id[item['id']])
+                        retry_after = max(retry_after, float(item.get('headers', {}).get('Retry-After', 1)))
+            
+            if not throttled or attempt == max_attempts - 1:
+                break
+            # Retry only the throttled items (dependsOn would point at requests no longer in the batch)
+            self.requests = [{k: v for k, v in request.items() if k != 'dependsOn'} for request in throttled]
+            time.sleep(retry_after)
+        
+        self.requests = []
+        return results
+
+
+class QuickXorHash:
+    """OneDrive/SharePoint quickXorHash, the content hash Graph reports for drive files
+    
+    Byte n of the input is XORed into a 160-bit state at bit (11 * n) mod 160,
+    wrapping around; the total length is XORed into the last 8 bytes. Since the
+    bit position only depends on n mod 160, input is folded 160 bytes at a time.
+    """
+    
+    WIDTH = 160
+    SHIFT = 11
+    MASK = (1 << 160) - 1
+    
+    def __init__(self):
+        self._folded = 0  # Byte k holds the XOR of every input byte at index = k (mod 160)
+        self._length = 0
+    
+    def update(self, data):
+        lead = self._length % self.WIDTH
+        buf = bytes(lead) + bytes(data)
+        buf += bytes(-len(buf) % self.WIDTH)
+        folded = self._folded
+        for start in range(0, len(buf), self.WIDTH):
+            folded ^= int.from_bytes(buf[start:start + self.WIDTH], 'little')
+        self._folded = folded
+        self._length += len(data)
+    
+    def digest(self):
+        state = 0
+        for k in range(self.WIDTH):
+            value = (self._folded >> (8 * k)) & 0xFF
+            if not value:
+                continue
+            position = (self.SHIFT * k) % self.WIDTH
+            state ^= (value << position) & self.MASK
+            if position > self.WIDTH - 8:
+                state ^= value >> (self.WIDTH - position)
+        result = bytearray(state.to_bytes(20, 'little'))
+        for i, length_byte in enumerate(self._length.to_bytes(8, 'little')):
+            result[12 + i] ^= length_byte
+        return bytes(result)
+    
+    def b64digest(self):
+        """Digest in the base64 form used by Graph's file.hashes.quickXorHash"""
+        return base64.b64encode(self.digest()).decode('ascii')
+    
+    @classmethod
+    def of_file(cls, path, block_size=1024 * 1024):
+        hasher = cls()
+        # path.open works for Path objects and InMemoryReport alike
+        with path.open('rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                hasher.update(block)
+        return hasher.b64digest()
+
+
+class InMemoryReport:
+    """An extracted PDF kept in memory instead of a temp file
+    
+    Offers the parts of the pathlib.Path interface the uploader uses (name,
+    stat().st_size, open('rb')), so it can sit in downloaded_files next to
+    spilled-to-disk Paths.
+    """
+    
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+    
+    def stat(self):
+        return os.stat_result((0, 0, 0, 0, 0, 0, self.size, 0, 0, 0))
+    
+    def open(self, mode='rb'):
+        if mode != 'rb':
+            raise ValueError("InMemoryReport is read-only")
+        if self.data is None:
+            raise ValueError(f"{self.name} was already released from memory")
+        return io.BytesIO(self.data)
+    
+    def release(self):
+        """Drop the bytes once the file is safely in SharePoint"""
+        self.data = None
+    
+    def __fspath__(self):
+        raise TypeError(f"{self.name} is held in memory and has no path")
+    
+    def __repr__(self):
+        return f"InMemoryReport({self.name!r}, {self.size} bytes)"
+
+
+class UploadPipeline:
+    """Uploads files to SharePoint while the rest of the ZIP is still being extracted
+    
+    The extraction loop submit()s each PDF as soon as it is written; a bounded
+    queue feeds UPLOAD_CONCURRENCY worker threads, so a slow upload side
+    throttles extraction instead of piling files up. finish() waits for the
+    queue to drain and returns the per-file results in submission order.
+    """
+    
+    def __init__(self, automation, workers, max_queued):
+        import queue
+        
+        self.automation = automation
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.order = []
+        self.results = {}
+        self.threads = []
+        self.connection = None
+        self.index_ready = False
+        self.started = False
+        self._refresh_lock = threading.Lock()
+    
+    def _start(self):
+        self.started = True
+        self.connection = self.automation._connect_sharepoint()
+        if not self.connection:
+            return
+        graph, ids, access_token = self.connection
+        self.index_ready = self.automation._sync_sharepoint_index(graph, ids, access_token)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f"Upload pipeline started with {self.workers} worker(s)")
+    
+    def submit(self, filepath):
+        """Queue a freshly extracted file for upload (blocks while the queue is full)"""
+        if not self.started:
+            self._start()
+        if not self.connection:
+            return
+        self.order.append(filepath)
+        self.queue.put(filepath)
+    
+    def _work(self):
+        while True:
+            filepath = self.queue.get()
+            if filepath is None:
+                return
+            try:
+                self.results[filepath] = self._upload(filepath)
+                if isinstance(filepath, InMemoryReport) and \
+                        (self.results[filepath].get('ok') or self.results[filepath].get('skipped')):
+                    filepath.release()
+            except Exception as e:
+                self.results[filepath] = {
+                    'name': filepath.name, 'ok': False, 'web_url': '', 'not_found': False,
+                    'error': f"Error uploading {filepath.name}: {str(e)}", 'seconds': 0.0
+                }
+    
+    def _upload(self, filepath):
+        automation = self.automation
+        graph, ids, access_token = self.connection
+        
+        # Files arrive one at a time: use the local folder index, else one lookup per file
+        if self.index_ready:
+            item = automation.sharepoint_index.lookup(ids['folder_id'], [filepath.name]).get(filepath.name)
+        else:
+            item_url = automation._drive_item_url(ids, filepath.name)
+            response = graph.get(
+                f"{item_url}?$select=id,name,size,file,webUrl",
+                headers={'Authorization': f'Bearer {access_token}'}
+            )
+            item = response.json() if response.status_code == 200 else None
+        skipped = automation._unchanged_in_sharepoint(filepath, item)
+        if skipped:
+            return skipped
+        
+        result = automation._upload_file(graph, ids, access_token, filepath)
+        if result.get('not_found'):
+            with self._refresh_lock:
+                if self.connection[1] is ids:
+                    print("SharePoint target not found with cached ids, resolving again...")
+                    fresh = automation._resolve_sharepoint_ids(graph, access_token, refresh=True)
+                    if fresh:
+                        self.connection = (graph, fresh, access_token)
+            if self.connection[1] is not ids:
+                result = automation._upload_file(graph, self.connection[1], access_token, filepath)
+        return result
+    
+    def finish(self):
+        """Wait for every queued upload and return the results in submission order"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return [self.results[filepath] for filepath in self.order if filepath in self.results]
+
+
+class SharePointIndex:
+    """Local SQLite mirror of the SharePoint reports folder, kept current with Graph delta queries
+    
+    Holds name, size, quickXorHash, webUrl and item id for every file in the
+    folder, plus the delta link to continue from, so dedup and email links are
+    local lookups instead of folder listings. SharePoint only supports delta on
+    the drive root, so the root's changes are read and filtered by parent folder.
+    """
+    
+    def __init__(self, path):
+        import sqlite3
+        
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Every account in --accounts opens this file on its own connection
+        self.conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                " item_id TEXT PRIMARY KEY,"
+                " folder_id TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " size INTEGER,"
+                " quick_xor_hash TEXT,"
+                " web_url TEXT)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS items_by_name ON items (folder_id, name)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS delta_links ("
+                " folder_id TEXT PRIMARY KEY,"
+                " delta_link TEXT NOT NULL,"
+                " synced_at TEXT NOT NULL)"
+            )
+    
+    def _apply(self, folder_id, items):
+        """Apply one page of delta results; returns how many changes touched the folder"""
+        applied = 0
+        with self._lock, self.conn:
+            for item in items:
+                parent_id = (item.get('parentReference') or {}).get('id')
+                if 'deleted' in item or parent_id != folder_id or 'file' not in item:
+                    # Deleted, moved out of the folder, or not a file in it (root delta covers the whole drive)
+                    applied += self.conn.execute("DELETE FROM items WHERE item_id = ?", (item['id'],)).rowcount
+                    continue
+                applied += 1
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO items (item_id, folder_id, name, size, quick_xor_hash, web_url)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        item['id'], folder_id, item.get('name'), item.get('size'),
+                        ((item.get('file') or {}).get('hashes') or {}).get('quickXorHash'),
+                        item.get('webUrl')
+                    )
+                )
+        return applied
+    
+    def sync(self, graph, access_token, drive_id, folder_id):
+        """Bring the index up to date; returns the number of changes applied"""
+        headers = {'Authorization': f'Bearer {access_token}'}
+        select = "$select=id,name,size,file,webUrl,parentReference,deleted"
+        full_sync_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root/delta?{select}"
+        
+        with self._lock:
+            row = self.conn.execute("SELECT delta_link FROM delta_links WHERE folder_id = ?", (folder_id,)).fetchone()
+        url = row[0] if row else full_sync_url
+        changes = 0
+        
+        while url:
+            response = graph.get(url, headers=headers)
+            if response.status_code == 410 or (response.status_code == 400 and row):
+                # The delta token expired: start again from a full enumeration
+                print("SharePoint index delta link expired, rebuilding the index...")
+                with self._lock, self.conn:
+                    self.conn.execute("DELETE FROM items WHERE folder_id = ?", (folder_id,))
+                    self.conn.execute("DELETE FROM delta_links WHERE folder_id = ?", (folder_id,))
+                row = None
+                url = full_sync_url
+                continue
+            if response.status_code != 200:
+                raise RuntimeError(f"Delta query failed: HTTP {response.status_code} - {response.text}")
+            
+            page = response.json()
+            changes += self._apply(folder_id, page.get('value', []))
+            url = page.get('@odata.nextLink')
+            delta_link = page.get('@odata.deltaLink')
+            if delta_link:
+                with self._lock, self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO delta_links (folder_id, delta_link, synced_at) VALUES (?, ?, ?)",
+                        (folder_id, delta_link, datetime.now().isoformat())
+                    )
+        return changes
+    
+    def lookup(self, folder_id, names):
+        """Return {name: drive-item-shaped dict} for the given file names present in the folder"""
+        found = {}
+        names = list(names)
+        with self._lock:
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT item_id, name, size, quick_xor_hash, web_url FROM items"
+                    f" WHERE folder_id = ? AND name IN ({placeholders})",
+                    [folder_id, *chunk]
+                ).fetchall()
+                for item_id, name, size, quick_xor_hash, web_url in rows:
+                    found[name] = {
+                        'id': item_id,
+                        'name': name,
+                        'size': size,
+                        'file': {'hashes': {'quickXorHash': quick_xor_hash}} if quick_xor_hash else {},
+                        'webUrl': web_url
+                    }
+        return found
+    
+    def record_upload(self, folder_id, item):
+        """Add a just-uploaded drive item without waiting for the next delta sync"""
+        item = dict(item)
+        item.setdefault('parentReference', {'id': folder_id})
+        self._apply(folder_id, [item])
+    
+    def close(self):
+        self.conn.close()
+
+
+@dataclass
+class AccountProfile:
+    """One lab account for the multi-account runner; unset fields fall back to .env"""
+    name: str
+    portal_username: str
+    portal_password: str
+    sharepoint_folder: str = None
+    email_to: str = None  # Comma-separated recipients
+    email_sender: str = None  # Mailbox the notification is sent from
+    portal_url: str = None
+    sharepoint_site: str = None
+    tenant_id: str = None
+    client_id: str = None
+    client_secret: str = None
+    
+    @classmethod
+    def load_all(cls, path):
+        """Read a JSON list of account objects, naming the entry at fault on bad input"""
+        from dataclasses import fields
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, list) or not data:
+            raise ValueError(f"{path} must contain a JSON list of accounts")
+        
+        known = {item.name for item in fields(cls)}
+        required = {'name', 'portal_username', 'portal_password'}
+        accounts = []
+        for position, entry in enumerate(data, start=1):
+            label = f"{path} entry {position}"
+            if not isinstance(entry, dict):
+                raise ValueError(f"{label}: expected an object")
+            label += f" ({entry.get('name', 'unnamed')})"
+            unknown = set(entry) - known
+            if unknown:
+                raise ValueError(f"{label}: unknown field(s) {', '.join(sorted(unknown))}")
+            missing = required - set(entry)
+            if missing:
+                raise ValueError(f"{label}: missing field(s) {', '.join(sorted(missing))}")
+            # The name becomes part of session, ledger and download paths
+            name = entry['name']
+            if not isinstance(name, str) or not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9_.-]{0,63}', name) or '..' in name:
+                raise ValueError(f"{label}: name may only use letters, digits, '.', '_' and '-'")
+            accounts.append(cls(**entry))
+        
+        names = [account.name for account in accounts]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Account names must be unique in {path}: {', '.join(duplicates)}")
+        return accounts
+
 
 class WaterReportAutomation:
     """Main automation class for water report processing"""
     
-    def __init__(self):
-        self.portal_url = os.getenv('PORTAL_URL')
-        self.portal_username = os.getenv('PORTAL_USERNAME')
-        self.portal_password = os.getenv('PORTAL_PASSWORD')
-        self.download_path = Path(os.getenv('DOWNLOAD_PATH', './downloads'))
-        self.sharepoint_site = os.getenv('SHAREPOINT_SITE_URL')
-        self.sharepoint_folder = os.getenv('SHAREPOINT_FOLDER_PATH')
+    def __init__(self, account=None):
+        self.account = account  # AccountProfile when run by the multi-account runner
+        self.portal_url = (account and account.portal_url) or os.getenv('PORTAL_URL')
+        self.portal_username = account.portal_username if account else os.getenv('PORTAL_USERNAME')
+        self.portal_password = account.portal_password if account else os.getenv('PORTAL_PASSWORD')
+        self.download_path = self._account_path(os.getenv('DOWNLOAD_PATH', './downloads'), folder=True)
+        self.sharepoint_site = (account and account.sharepoint_site) or os.getenv('SHAREPOINT_SITE_URL')
+        self.sharepoint_folder = (account and account.sharepoint_folder) or os.getenv('SHAREPOINT_FOLDER_PATH')
+        self.email_to = (account and account.email_to) or os.getenv('EMAIL_TO')
+        self.email_sender = (account and account.email_sender) or os.getenv('EMAIL_SENDER_ADDRESS')
+        self.graph_credentials = (
+            (account and account.tenant_id) or os.getenv('SHAREPOINT_TENANT_ID'),
+            (account and account.client_id) or os.getenv('SHAREPOINT_CLIENT_ID'),
+            (account and account.client_secret) or os.getenv('SHAREPOINT_CLIENT_SECRET')
+        )
+        self.portal_engine = os.getenv('PORTAL_ENGINE', 'browser').lower()  # 'browser' or 'http'
+        self.browser_profile = os.getenv('BROWSER_PROFILE', 'production').lower()  # 'production' or 'debug'
+        self.blocked_requests = 0  # Requests aborted by the production profile
+        self.http = HTTP_POOLS
         self.downloaded_files = []
         self.uploaded_files = []
         self.uploaded_files_urls = {}  # Dictionary to store filename -> SharePoint URL mapping
+        self.skipped_files = []  # {'name', 'bytes', 'web_url'} for files already identical in SharePoint
+        self.grid_rows = []  # GridRow records from the last grid snapshot
+        self.download_stats = []  # One {'filename', 'bytes', 'sha256', 'source'} record per download
+        self.stream_stats = []  # One {'name', 'bytes', 'seconds', 'mb_per_s'} record per streamed file/member
+        self.stream_chunk_size = int(os.getenv('STREAM_CHUNK_KB', '1024')) * 1024
+        self.waits = PortalWaits()
+        self.session_store = SessionStore(
+            self._account_path(os.getenv('SESSION_STATE_PATH', './.session/portal_state.enc')),
+            self.portal_username,
+            self.portal_password,
+            key=os.getenv('SESSION_ENCRYPTION_KEY'),
+            max_age_hours=float(os.getenv('SESSION_MAX_AGE_HOURS', '12'))
+        )
+        self.saved_session = None  # Loaded SessionStore payload, if any
+        self.warm_landing_url = None  # Authenticated page of a warm context handed in by the daemon
+        self.landing_url = None  # Page the portal session ended up on after login/resume
+        self.ledger = ReportLedger(self._account_path(os.getenv('LEDGER_PATH', './.state/reports_ledger.db')))
+        self.initial_start_date = os.getenv('REPORT_START_DATE', '2025-11-11')  # Used until a watermark exists
+        self.ledger_lookback_days = int(os.getenv('LEDGER_LOOKBACK_DAYS', '3'))
+        self.date_range = (None, None)  # (start, end) actually requested from the portal
+        self.selected_rows = []  # GridRow records chosen for download this run
+        self.fixed_date_range = None  # (start, end) that overrides the watermark window
+        self.include_today = False  # Intraday polling: the window ends today instead of yesterday
+        self.poll_state = None  # GridPollState when polling, to only act on changed rows
+        self.download_timeout = int(os.getenv('DOWNLOAD_TIMEOUT_MS', '15000'))
+        self.backfill_window_days = int(os.getenv('BACKFILL_WINDOW_DAYS', '7'))
+        self.backfill_parallel = int(os.getenv('BACKFILL_PARALLEL', '3'))
+        self.backfill_retries = int(os.getenv('BACKFILL_RETRIES', '2'))
+        self.window_results = []  # Per-window outcome of a backfill run
+        self.work_queue = None  # Shared WorkQueue and the Job being run, when started by a QueueWorker
+        self.work_job = None
+        self.cancelled = threading.Event()  # Set to stop uploads that are still queued on worker threads
+        self.upload_concurrency = int(os.getenv('UPLOAD_CONCURRENCY', '4'))
+        self.upload_session_threshold = int(float(os.getenv('UPLOAD_SESSION_THRESHOLD_MB', '4')) * 1024 * 1024)
+        # Graph requires upload session chunks to be a multiple of 320 KiB
+        self.upload_chunk_size = int(os.getenv('UPLOAD_CHUNK_UNITS', '16')) * 320 * 1024
+        self.sharepoint_ids = SharePointIdCache(
+            os.getenv('SHAREPOINT_ID_CACHE_PATH', './.state/sharepoint_ids.json'),
+            ttl_hours=float(os.getenv('SHAREPOINT_ID_CACHE_TTL_HOURS', '24'))
+        )
+        self.upload_sessions = UploadSessionStore(os.getenv('UPLOAD_SESSIONS_PATH', './.state/upload_sessions.json'))
+        # SharePoint library columns (internal names) for report metadata; unset = no tagging
+        self.metadata_sample_field = os.getenv('SHAREPOINT_SAMPLE_ID_FIELD')
+        self.metadata_date_field = os.getenv('SHAREPOINT_REPORT_DATE_FIELD')
+        self.pipeline_uploads = os.getenv('PIPELINE_UPLOADS', 'false').lower() == 'true'
+        # Zero-temp-file mode: PDFs up to the spill threshold go from the ZIP to the uploader in memory
+        self.upload_from_memory = os.getenv('UPLOAD_FROM_MEMORY', 'false').lower() == 'true'
+        self.memory_spill_threshold = int(float(os.getenv('MEMORY_SPILL_THRESHOLD_MB', '16')) * 1024 * 1024)
+        self.memory_hold_limit = int(float(os.getenv('MEMORY_HOLD_LIMIT_MB', '256')) * 1024 * 1024)
+        self.keep_local_copy = os.getenv('KEEP_LOCAL_COPY', 'true').lower() == 'true'
+        self.local_copy_writer = None  # Background writer for the optional local archive copy
+        self.upload_pipeline = None  # UploadPipeline while a pipelined run is downloading
+        self.sharepoint_index = None
+        if os.getenv('SHAREPOINT_INDEX', 'true').lower() == 'true':
+            self.sharepoint_index = SharePointIndex(os.getenv('SHAREPOINT_INDEX_PATH', './.state/sharepoint_index.db'))
+        self.index_synced = False  # True once the index was delta-synced this run
+        self.upload_stats = []  # One {'name', 'ok', 'web_url', 'error', 'seconds'} record per upload
         self.errors = []
         
         # Create download directory if it doesn't exist
         self.download_path.mkdir(parents=True, exist_ok=True)
     
+    def _account_path(self, path, folder=False):
+        """Give each account of the multi-account runner its own session, ledger and downloads"""
+        path = Path(path)
+        if not self.account:
+            return path
+        if folder:
+            return path / self.account.name
+        return path.with_name(f"{path.stem}_{self.account.name}{path.suffix}")
+    
     async def login_to_portal(self, page):
         """Login to Precision Agri-Lab portal"""
         try:
@@ -54,6 +1574,7 @@ class WaterReportAutomation:
             await page.wait_for_load_state('networkidle', timeout=30000)
             
             print("Login successful!")
+            await self.save_session(page)
             return True
             
         except Exception as e:
@@ -62,12 +1583,317 @@ class WaterReportAutomation:
             self.errors.append(error_msg)
             return False
     
+    def _is_login_page(self, url):
+        """True if the URL points at the portal's login form"""
+        login_path = urlparse(self.portal_url).path.lower() if self.portal_url else '/login.aspx'
+        return urlparse(url).path.lower() == login_path or 'login.aspx' in url.lower()
+    
+    async def resume_session(self, page):
+        """Open the portal with a saved session, returning False if it has expired
+        
+        A warm context (daemon mode) is already authenticated, so its last landing
+        page is tried even when no session file was loaded.
+        """
+        if not self.saved_session and not self.warm_landing_url:
+            return False
+        
+        landing_url = self.warm_landing_url or self.saved_session.get('landing_url') or self.portal_url
+        try:
+            print(f"Reusing saved portal session: {landing_url}")
+            await page.goto(landing_url, wait_until='domcontentloaded', timeout=30000)
+            
+            # An expired ASP.NET session bounces back to the login form
+            if self._is_login_page(page.url) or await page.locator('input[type="password"]').count() > 0:
+                print("Saved session has expired, logging in again...")
+                self.session_store.clear()
+                self.warm_landing_url = None
+                return False
+            
+            print("Saved session is still valid, skipping login")
+            await self.save_session(page)
+            return True
+            
+        except Exception as e:
+            print(f"Could not reuse saved session: {e}")
+            return False
+    
+    async def save_session(self, page):
+        """Persist the authenticated storage state for the next run"""
+        self.landing_url = page.url
+        if not self.session_store.enabled:
+            return
+        try:
+            storage_state = await page.context.storage_state()
+            self.session_store.save(storage_state, page.url)
+        except Exception as e:
+            print(f"Warning: could not save portal session: {e}")
+    
+    async def ensure_logged_in(self, page):
+        """Reuse the saved session when possible, otherwise do a full login"""
+        if await self.resume_session(page):
+            return True
+        return await self.login_to_portal(page)
+    
+    async def snapshot_grid(self, page):
+        """Read every row of the water reports grid with a single page.evaluate call"""
+        data = await page.evaluate(GRID_SNAPSHOT_JS, GRID_SELECTOR)
+        if data is None:
+            print(f"Water reports grid not found: {GRID_SELECTOR}")
+            return []
+        return [GridRow.from_snapshot(item, data['headers']) for item in data['rows']]
+    
+    async def select_rows(self, page, rows):
+        """Tick the checkboxes of the given grid rows in one in-page operation
+        
+        Returns the set of checkbox ids that the grid reports as checked afterwards.
+        """
+        wanted_ids = [row.checkbox_id for row in rows if row.checkbox_id]
+        if not wanted_ids:
+            return set()
+        
+        result = await page.evaluate(BULK_SELECT_JS, [GRID_SELECTOR, wanted_ids])
+        
+        if result['autopostback']:
+            # Each tick posts back to the server, so it has to be one click at a time
+            print("Checkboxes post back on change, selecting rows one by one...")
+            for checkbox_id in result['pending']:
+                await page.click(f'[id="{checkbox_id}"]')
+                await self.waits.postback(page)
+        
+        if result['missing']:
+            print(f"Warning: {len(result['missing'])} checkbox(es) no longer on the page")
+        
+        # Read back what the grid actually has selected
+        checked_ids = set(await page.evaluate(SELECTED_IDS_JS, GRID_SELECTOR))
+        not_selected = [checkbox_id for checkbox_id in wanted_ids if checkbox_id not in checked_ids]
+        if not_selected:
+            error_msg = f"{len(not_selected)} report(s) could not be selected: {', '.join(not_selected)}"
+            print(error_msg)
+            self.errors.append(error_msg)
+        
+        return checked_ids & set(wanted_ids)
+    
+    def report_date_range(self):
+        """Return the (start, end) dates to request from the portal, as YYYY-MM-DD
+        
+        The window ends yesterday and starts a few days before the last successful
+        run's watermark, so missed days are caught up and late-finishing reports
+        are still seen. The ledger keeps already-processed rows from being selected.
+        """
+        # Calculate yesterday's date
+        yesterday = datetime.now() - timedelta(days=1)
+        target_date = datetime.now().strftime('%Y-%m-%d') if self.include_today else yesterday.strftime('%Y-%m-%d')
+        
+        if self.fixed_date_range:
+            return self.fixed_date_range
+        
+        watermark = self.ledger.get_watermark()
+        if watermark:
+            start = datetime.strptime(watermark, '%Y-%m-%d') - timedelta(days=self.ledger_lookback_days)
+            starget_date = min(start, yesterday).strftime('%Y-%m-%d')
+        else:
+            starget_date = self.initial_start_date
+        return starget_date, target_date
+    
+    def choose_rows_to_download(self, rows):
+        """Pick the 'water' rows that have not been processed yet
+        
+        Returns (rows_to_select, skipped_count) and remembers the chosen rows in
+        self.selected_rows so the ledger can be updated once they are uploaded.
+        """
+        print("\nFiltering reports by status...")
+        changed = self.poll_state.changed_ids(rows) if self.poll_state else None
+        if self.poll_state and changed is None:
+            print("Grid unchanged since the last poll, nothing to do")
+            self.selected_rows = []
+            return [], len(rows)
+        
+        processed = self.ledger.processed_ids([row.report_id for row in rows if row.report_id])
+        water_rows = []
+        skipped_count = 0
+        
+        for row in rows:
+            # If we found both checkbox and status, decide whether to select
+            if row.checkbox_id and row.status:
+                if row.status == 'water' and changed is not None and row.report_id not in changed:
+                    # Polling: this row was already 'water' at the last poll
+                    skipped_count += 1
+                    print(f"  Row {row.index+1}: Report {row.report_id} unchanged since last poll - SKIPPED")
+                elif row.status == 'water' and row.report_id in processed:
+                    # Already downloaded and uploaded by an earlier run
+                    skipped_count += 1
+                    print(f"  Row {row.index+1}: Report {row.report_id} already processed - SKIPPED")
+                elif row.status == 'water':
+                    # Only select if status is "water"
+                    water_rows.append(row)
+                    print(f"  Row {row.index+1}: Status = '{row.status}' - SELECTED")
+                else:
+                    # Skip "in progress" reports
+                    skipped_count += 1
+                    print(f"  Row {row.index+1}: Status = '{row.status}' - SKIPPED")
+            else:
+                print(f"  Row {row.index+1}: Could not determine status or find checkbox")
+        
+        if self.work_job and water_rows:
+            # Other workers may already have (or be uploading) some of these reports
+            claimed = self.work_queue.claim_reports(
+                self.work_job, [row.report_id for row in water_rows if row.report_id]
+            )
+            for row in [row for row in water_rows if row.report_id not in claimed]:
+                water_rows.remove(row)
+                skipped_count += 1
+                print(f"  Row {row.index+1}: Report {row.report_id} handled by another worker - SKIPPED")
+        
+        self.selected_rows = water_rows
+        return water_rows, skipped_count
+    
+    def _all_files_delivered(self):
+        """True if every downloaded file was uploaded or found unchanged in SharePoint"""
+        return len(self.uploaded_files) + len(self.skipped_files) == len(self.downloaded_files)
+    
+    def update_ledger(self):
+        """Record this run's delivered reports and move the watermark forward
+        
+        Each report whose files all reached SharePoint is recorded on its own.
+        The watermark only moves up to the day before the earliest report that
+        is still undelivered or 'in progress', so the next date range still
+        reaches back to it, and one stuck report cannot freeze it for good.
+        """
+        if self.window_results:
+            # Backfill: record every window whose files all made it to SharePoint
+            uploaded = set(self.uploaded_files) | {skipped['name'] for skipped in self.skipped_files}
+            recorded = 0
+            for result in self.window_results:
+                if result['ok'] and all(path.name in uploaded for path in result['files']):
+                    report_ids = [row.report_id for row in result['rows'] if row.report_id]
+                    self.ledger.mark_processed(report_ids, datetime.now().strftime('%Y-%m-%d'))
+                    recorded += len(report_ids)
+            print(f"Ledger updated: {recorded} report(s) from backfill")
+            return
+        
+        if self.errors and not self.selected_rows:
+            # Failed before any report was chosen (login, grid, ...): nothing is known
+            print("Run had errors, ledger and watermark left unchanged")
+            return
+        
+        delivered_names = set(self.uploaded_files) | {skipped['name'] for skipped in self.skipped_files}
+        names = [filepath.name for filepath in self.downloaded_files]
+        delivered, undelivered = [], []
+        for row in self.selected_rows:
+            if not row.report_id:
+                continue
+            files = [name for name in names if self._report_in_filename(row.report_id, name)]
+            if files:
+                ok = all(name in delivered_names for name in files)
+            else:
+                # Its file can't be told apart: only trust a run where everything made it
+                ok = not self.errors and self._all_files_delivered()
+            (delivered if ok else undelivered).append(row)
+        
+        report_ids = [row.report_id for row in delivered]
+        if self.work_job:
+            # Queue jobs are backfill windows: record the reports, leave the daily watermark alone
+            self.work_queue.mark_reports_uploaded(self.work_job, report_ids)
+            self.ledger.mark_processed(report_ids, datetime.now().strftime('%Y-%m-%d'))
+            print(f"Ledger and work queue updated: {len(report_ids)} report(s), {len(undelivered)} undelivered")
+            return
+        self.ledger.mark_processed(report_ids, datetime.now().strftime('%Y-%m-%d'))
+        
+        # Reports still 'in progress' have to stay inside the next run's date range
+        in_progress = [row for row in self.grid_rows if row.status == 'in progress']
+        
+        watermark = self.date_range[1]
+        pending = undelivered + in_progress
+        if pending:
+            dates = [self._row_date(row) for row in pending]
+            if None in dates:
+                print(f"Ledger updated: {len(report_ids)} report(s); {len(undelivered)} undelivered, "
+                      f"{len(in_progress)} in progress, one without a date, watermark left unchanged")
+                return
+            earliest = datetime.strptime(min(dates), '%Y-%m-%d') - timedelta(days=1)
+            watermark = min(watermark, earliest.strftime('%Y-%m-%d'))
+        self.ledger.set_watermark(watermark)
+        print(f"Ledger updated: {len(report_ids)} report(s), {len(undelivered)} undelivered, "
+              f"{len(in_progress)} in progress, watermark {watermark}")
+    
+    async def filter_and_download_reports_http(self):
+        """Browserless equivalent of filter_and_download_reports
+        
+        Returns False if the portal pages did not match what the HTTP client
+        expects, in which case the caller should fall back to the browser.
+        """
+        from portal_http_client import PortalStructureError
+        try:
+            await asyncio.to_thread(self._filter_and_download_reports_http)
+            return True
+        except PortalStructureError as e:
+            print(f"HTTP engine could not handle the portal page ({e}), falling back to the browser")
+            return False
+        except Exception as e:
+            error_msg = f"Error during report filtering/download (HTTP engine): {str(e)}"
+            print(error_msg)
+            self.errors.append(error_msg)
+            return True
+    
+    def _filter_and_download_reports_http(self):
+        """Blocking body of filter_and_download_reports_http"""
+        from portal_http_client import PortalHttpClient
+        
+        client = PortalHttpClient(
+            self.portal_url, self.portal_username, self.portal_password,
+            session=self.http.session(f'portal:{self.account.name}' if self.account else 'portal')
+        )
+        
+        print(f"Logging in to portal over HTTP: {self.portal_url}")
+        client.login()
+        print("Login successful!")
+        
+        client.open_water_reports()
+        self.date_range = self.report_date_range()
+        starget_date, target_date = self.date_range
+        print(f"Requesting water reports from {starget_date} to {target_date}...")
+        grid_rows = client.set_date_range(starget_date, target_date)
+        rows = [GridRow.from_snapshot(item, client.grid_headers()) for item in grid_rows]
+        self.grid_rows = rows
+        
+        if not rows or (len(rows) == 1 and "no water reports found" in rows[0].text.lower()):
+            print("No water reports found in the table for the selected date range.")
+            return
+        
+        print(f"Found {len(rows)} row(s) in the table")
+        water_rows, skipped_count = self.choose_rows_to_download(rows)
+        
+        print(f"\nSummary: {len(water_rows)} report(s) selected, {skipped_count} report(s) skipped")
+        if not water_rows:
+            print("No reports with 'water' status found to download.")
+            return
+        
+        today_str = datetime.now().strftime('%Y-%m-%d')
+        date_folder = self.download_path / today_str
+        date_folder.mkdir(parents=True, exist_ok=True)
+        
+        print("\nPosting 'Download Selected'...")
+        response, suggested_filename = client.download_selected(
+            [{'index': row.index, 'checkbox_name': row.checkbox_name} for row in water_rows]
+        )
+        archive_path = date_folder / suggested_filename
+        with response:
+            total = response.headers.get('Content-Length')
+            with open(archive_path, 'wb') as f:
+                self._copy_stream(
+                    response.iter_content(self.stream_chunk_size), f, suggested_filename,
+                    total=int(total) if total else None
+                )
+            expected_size = None if response.headers.get('Content-Encoding') else response.headers.get('Content-Length')
+        self._verify_download(archive_path, expected_size, source='http')
+        self._process_download(suggested_filename, archive_path, date_folder)
+        print(f"\nSuccessfully processed {len(self.downloaded_files)} report(s)")
+    
     async def filter_and_download_reports(self, page):
         """Filter for previous day reports and download all PDFs"""
         try:
             # Wait for the page to load completely
-            await page.wait_for_load_state('networkidle')
-            await asyncio.sleep(2)
+            await self.waits.page_ready(page)
             
             # Click on "View All Reports" link
             print("Clicking 'View All Reports'...")
@@ -75,9 +1901,9 @@ class WaterReportAutomation:
                 view_all_link = page.locator('xpath=//*[@id="content"]/h4/a')
                 if await view_all_link.count() > 0:
                     await view_all_link.click()
-                    await page.wait_for_load_state('networkidle')
+                    await self.waits.page_ready(page)
+                    await self.waits.selector(page, 'tabs', '#tabs')
                     print("Clicked 'View All Reports' successfully!")
-                    await asyncio.sleep(2)
                 else:
                     print("'View All Reports' link not found, continuing...")
             except Exception as e:
@@ -89,23 +1915,21 @@ class WaterReportAutomation:
             if await water_tab.count() > 0:
                 print("Found Water tab, clicking...")
                 await water_tab.first.click()
-                await page.wait_for_load_state('networkidle')
-                await asyncio.sleep(2)
+                await self.waits.postback(page)
+                await self.waits.selector(page, 'date_inputs', '#ContentPlaceHolder1_portalContent_txtStartDate')
             else:
                 print("Warning: Could not find Water tab, proceeding with all reports")
             
-            # Calculate yesterday's date
-            yesterday = datetime.now() - timedelta(days=1)
-            target_date = yesterday.strftime('%Y-%m-%d')
-            starget_date = "2025-11-11"
+            self.date_range = self.report_date_range()
+            starget_date, target_date = self.date_range
 
             # Type text on ContentPlaceHolder1_portalContent_txtStartDate field
             print("\nEntering start date...")
             try:
                 # For input type="date", we must use YYYY-MM-DD format with page.fill()
                 await page.fill('#ContentPlaceHolder1_portalContent_txtStartDate', starget_date)
+                await self.waits.input_value(page, '#ContentPlaceHolder1_portalContent_txtStartDate', starget_date)
                 print(f"Filled start date: {starget_date}")
-                await asyncio.sleep(1)
             except Exception as e:
                 print(f"Error entering start date: {e}")
 
@@ -114,31 +1938,28 @@ class WaterReportAutomation:
             try:
                 # For input type="date", we must use YYYY-MM-DD format with page.fill()
                 await page.fill('#ContentPlaceHolder1_portalContent_txtEndDate', target_date)
+                await self.waits.input_value(page, '#ContentPlaceHolder1_portalContent_txtEndDate', target_date)
                 print(f"Filled end date: {target_date}")
-                await asyncio.sleep(5)
             except Exception as e:
                 print(f"Error entering end date: {e}")
 
             # Click Update Date Range button
             print("\nClicking 'Update Date Range'...")
             try:
-                await page.click('#ContentPlaceHolder1_portalContent_btnSubmitDateChanges')
+                await self.waits.grid_refresh(
+                    page,
+                    lambda: page.click('#ContentPlaceHolder1_portalContent_btnSubmitDateChanges')
+                )
                 print("Clicked 'Update Date Range' button")
-                await page.wait_for_load_state('networkidle')
-                await asyncio.sleep(5)
             except Exception as e:
                 print(f"Error clicking update button: {e}")
             
             # Check if there are any reports available in the table
             print("Checking for available reports in the table...")
             
-            # Look for all rows in the water reports grid
-            # We need to check the "report" column value for each row
-            table_selector = '#ContentPlaceHolder1_portalContent_grdWaterReports'
-            
-            # Get all rows in the table body (skip header row)
-            # Use tbody tr selector as confirmed by debug script
-            rows = await page.locator(f'{table_selector} tbody tr').all()
+            # Snapshot every row of the water reports grid in one round trip
+            rows = await self.snapshot_grid(page)
+            self.grid_rows = rows
             
             print(f"DEBUG: Found {len(rows)} row(s) in tbody")
             
@@ -149,9 +1970,8 @@ class WaterReportAutomation:
             
             # Check if the only row is the "No Water Reports Found" message
             if len(rows) == 1:
-                first_row_text = await rows[0].inner_text()
-                print(f"DEBUG: First row text: '{first_row_text}'")
-                if "no water reports found" in first_row_text.lower():
+                print(f"DEBUG: First row text: '{rows[0].text}'")
+                if "no water reports found" in rows[0].text.lower():
                     print("No water reports found in the table for the selected date range.")
                     print("Please verify the date range or check if reports are available on the portal.")
                     return
@@ -159,52 +1979,10 @@ class WaterReportAutomation:
             print(f"Found {len(rows)} row(s) in the table")
             
             # Filter and select only reports with status "water" (not "in progress")
-            print("\nFiltering reports by status...")
-            selected_count = 0
-            skipped_count = 0
+            water_rows, skipped_count = self.choose_rows_to_download(rows)
             
-            for i, row in enumerate(rows):
-                try:
-                    # Get all cells in the row
-                    cells = await row.locator('td').all()
-                    
-                    # Find the "report" column value
-                    # The exact column index may vary, so we'll check cell text
-                    report_status = None
-                    checkbox = None
-                    
-                    # Look for checkbox in this row
-                    checkbox_in_row = row.locator('input[id*="chkWater"]')
-                    if await checkbox_in_row.count() > 0:
-                        checkbox = checkbox_in_row
-                    
-                    # Check each cell for the report status
-                    for cell in cells:
-                        cell_text = (await cell.inner_text()).strip()
-                        cell_text_lower = cell_text.lower()
-                        # Check for "Water" or "In Progress" (case-insensitive)
-                        if cell_text_lower in ['water', 'in progress']:
-                            report_status = cell_text_lower
-                            break
-                    
-                    # If we found both checkbox and status, decide whether to select
-                    if checkbox and report_status:
-                        if report_status == 'water':
-                            # Only select if status is "water"
-                            if not await checkbox.is_checked():
-                                await checkbox.click()
-                                await asyncio.sleep(0.5)  # Small delay between clicks
-                            selected_count += 1
-                            print(f"  Row {i+1}: Status = '{report_status}' - SELECTED")
-                        else:
-                            # Skip "in progress" reports
-                            skipped_count += 1
-                            print(f"  Row {i+1}: Status = '{report_status}' - SKIPPED")
-                    else:
-                        print(f"  Row {i+1}: Could not determine status or find checkbox")
-                        
-                except Exception as e:
-                    print(f"  Error processing row {i+1}: {e}")
+            selected_ids = await self.select_rows(page, water_rows)
+            selected_count = len(selected_ids)
             
             print(f"\nSummary: {selected_count} report(s) selected, {skipped_count} report(s) skipped")
             
@@ -224,83 +2002,45 @@ class WaterReportAutomation:
                     print(f"Using folder: {date_folder}")
                     
                     try:
-                        # Click and wait for download to start
-                        async with page.expect_download(timeout=15000) as download_info:
-                            await download_button.click()
-                            print("Clicked 'Download Selected' button")
-                        
-                        # Get the download object
-                        download = await download_info.value
-                        suggested_filename = download.suggested_filename
+                        # Remember the Content-Length of the attachment response so the
+                        # saved file can be checked against it
+                        attachment_sizes = []
+                        def on_response(response):
+                            headers = response.headers
+                            if 'attachment' in headers.get('content-disposition', '').lower():
+                                # A compressed transfer says nothing about the size on disk
+                                if not headers.get('content-encoding'):
+                                    attachment_sizes.append(headers.get('content-length'))
+                        page.on('response', on_response)
                         
-                        print(f"Download started: {suggested_filename}")
-                        
-                        # Get the download URL
-                        download_url = download.url
-                        print(f"Download URL: {download_url}")
-                        
-                        # Get cookies for authentication
-                        cookies = await page.context.cookies()
-                        cookie_dict = {cookie['name']: cookie['value'] for cookie in cookies}
-                        
-                        # Download the file using HTTP request
-                        print("Downloading file via HTTP...")
-                        response = requests.get(download_url, cookies=cookie_dict, timeout=60)
-                        
-                        if response.status_code == 200:
-                            print(f"Successfully downloaded {len(response.content)} bytes")
+                        # Click and wait for download to start
+                        try:
+                            async with page.expect_download(timeout=self.download_timeout) as download_info:
+                                await download_button.click()
+                                print("Clicked 'Download Selected' button")
                             
-                            # Check if it's a ZIP file
-                            if suggested_filename.lower().endswith('.zip'):
-                                print(f"Processing ZIP file...")
-                                
-                                # Extract ZIP in memory
-                                import zipfile
-                                import io
-                                
-                                try:
-                                    zip_buffer = io.BytesIO(response.content)
-                                    with zipfile.ZipFile(zip_buffer, 'r') as zip_ref:
-                                        extracted_files = zip_ref.namelist()
-                                        print(f"Found {len(extracted_files)} file(s) in ZIP")
-                                        
-                                        # Process each PDF file
-                                        for filename in extracted_files:
-                                            if filename.lower().endswith('.pdf'):
-                                                # Read PDF content from ZIP
-                                                pdf_content = zip_ref.read(filename)
-                                                
-                                                # Replace hyphens with underscores in filename
-                                                clean_filename = filename.replace('-', '_')
-                                                
-                                                # Save to temporary location for upload
-                                                temp_filepath = date_folder / clean_filename
-                                                with open(temp_filepath, 'wb') as f:
-                                                    f.write(pdf_content)
-                                                
-                                                self.downloaded_files.append(temp_filepath)
-                                                print(f"  - Extracted: {clean_filename}")
-                                    
-                                    print(f"Successfully extracted {len(self.downloaded_files)} PDF(s)")
-                                    
-                                except Exception as e:
-                                    error_msg = f"Error extracting ZIP file: {e}"
-                                    print(error_msg)
-                                    self.errors.append(error_msg)
-                            else:
-                                # Single PDF file
-                                clean_filename = suggested_filename.replace('-', '_')
-                                temp_filepath = date_folder / clean_filename
-                                
-                                with open(temp_filepath, 'wb') as f:
-                                    f.write(response.content)
-                                
-                                self.downloaded_files.append(temp_filepath)
-                                print(f"  - Downloaded: {clean_filename}")
-                        else:
-                            error_msg = f"Failed to download file: HTTP {response.status_code}"
+                            # Get the download object
+                            download = await download_info.value
+                            from portal_http_client import safe_filename
+                            suggested_filename = safe_filename(download.suggested_filename, 'WaterReports.zip')
+                            print(f"Download started: {suggested_filename}")
+                            
+                            # Save the browser's own copy; the payload crosses the network once
+                            archive_path = date_folder / suggested_filename
+                            await download.save_as(archive_path)
+                            failure = await download.failure()
+                        finally:
+                            page.remove_listener('response', on_response)
+                        
+                        if failure:
+                            error_msg = f"Failed to download file: {failure}"
                             print(error_msg)
                             self.errors.append(error_msg)
+                        else:
+                            expected_size = attachment_sizes[-1] if attachment_sizes else None
+                            self._verify_download(archive_path, expected_size, source='browser')
+                            # Off the event loop: extraction may block on the upload pipeline
+                            await asyncio.to_thread(self._process_download, suggested_filename, archive_path, date_folder)
                     
                     except Exception as e:
                         error_msg = f"Error during download: {str(e)}"
@@ -324,14 +2064,154 @@ class WaterReportAutomation:
             print(error_msg)
             self.errors.append(error_msg)
     
+    def _copy_stream(self, blocks, dst, label, total=None):
+        """Write an iterable of byte blocks to dst, recording progress and throughput
+        
+        Only one block is held in memory at a time, so memory use is bounded by
+        STREAM_CHUNK_KB regardless of how large the archive or member is.
+        """
+        started = time.monotonic()
+        written = 0
+        next_report = 0.25
+        for block in blocks:
+            if not block:
+                continue
+            dst.write(block)
+            written += len(block)
+            if total and total > self.stream_chunk_size * 8 and written / total >= next_report:
+                print(f"    {label}: {written * 100 // total}% ({written}/{total} bytes)")
+                next_report += 0.25
+        
+        elapsed = time.monotonic() - started
+        throughput = written / elapsed / (1024 * 1024) if elapsed > 0 else 0.0
+        self.stream_stats.append({
+            'name': label,
+            'bytes': written,
+            'seconds': round(elapsed, 3),
+            'mb_per_s': round(throughput, 2)
+        })
+        return written
+    
+    def _verify_download(self, archive_path, expected_size=None, source='browser'):
+        """Check a downloaded file against the server's size and record its hash
+        
+        Raises ValueError if the file is empty, truncated, or not a readable ZIP.
+        """
+        import zipfile
+        
+        size = archive_path.stat().st_size
+        sha256 = hashlib.sha256()
+        with open(archive_path, 'rb') as f:
+            for block in iter(lambda: f.read(self.stream_chunk_size), b''):
+                sha256.update(block)
+        
+        if size == 0:
+            raise ValueError(f"Downloaded file {archive_path.name} is empty")
+        if expected_size is not None and int(expected_size) != size:
+            raise ValueError(
+                f"Downloaded file {archive_path.name} is {size} bytes, server announced {expected_size}"
+            )
+        if archive_path.suffix.lower() == '.zip':
+            with zipfile.ZipFile(archive_path) as zip_ref:
+                bad_member = zip_ref.testzip()
+            if bad_member:
+                raise ValueError(f"Downloaded ZIP {archive_path.name} is corrupt at {bad_member}")
+        
+        self.download_stats.append({
+            'filename': archive_path.name,
+            'bytes': size,
+            'sha256': sha256.hexdigest(),
+            'source': source
+        })
+        print(f"Successfully downloaded {size} bytes (sha256 {sha256.hexdigest()[:12]}...)")
+    
+    def _memory_held(self):
+        """Bytes of extracted PDFs still held in memory, waiting for (or failed) upload"""
+        return sum(
+            filepath.size for filepath in self.downloaded_files
+            if isinstance(filepath, InMemoryReport) and filepath.data is not None
+        )
+    
+    def _process_download(self, suggested_filename, archive_path, date_folder):
+        """Extract a downloaded ZIP into date_folder (a single PDF is used as-is)"""
+        from portal_http_client import safe_filename
+        
+        # Check if it's a ZIP file
+        if suggested_filename.lower().endswith('.zip'):
+            print(f"Processing ZIP file...")
+
+            import zipfile
+
+            try:
+                with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+                    extracted_files = zip_ref.namelist()
+                    print(f"Found {len(extracted_files)} file(s) in ZIP")
+
+                    # Process each PDF file, streaming it out in fixed-size blocks
+                    for member in zip_ref.infolist():
+                        filename = member.filename
+                        if filename.lower().endswith('.pdf'):
+                            # Replace hyphens with underscores in filename
+                            # Member names come from the server too: no directories, no ../
+                            clean_filename = safe_filename(filename, '').replace('-', '_')
+                            if not clean_filename:
+                                continue
+
+                            temp_filepath = date_folder / clean_filename
+                            if self.upload_from_memory and member.file_size <= self.memory_spill_threshold \
+                                    and self._memory_held() + member.file_size <= self.memory_hold_limit:
+                                # Keep the PDF in memory and hand it straight to the uploader
+                                buffer = io.BytesIO()
+                                with zip_ref.open(member) as src:
+                                    self._copy_stream(
+                                        iter(lambda: src.read(self.stream_chunk_size), b''),
+                                        buffer, clean_filename, total=member.file_size
+                                    )
+                                report = InMemoryReport(clean_filename, buffer.getvalue())
+                                if self.local_copy_writer:
+                                    self.local_copy_writer.submit(temp_filepath.write_bytes, report.data)
+                                temp_filepath = report
+                            else:
+                                # Save to temporary location for upload
+                                with zip_ref.open(member) as src, open(temp_filepath, 'wb') as f:
+                                    self._copy_stream(
+                                        iter(lambda: src.read(self.stream_chunk_size), b''),
+                                        f, clean_filename, total=member.file_size
+                                    )
+
+                            self.downloaded_files.append(temp_filepath)
+                            print(f"  - Extracted: {clean_filename}")
+                            if self.upload_pipeline:
+                                self.upload_pipeline.submit(temp_filepath)
+
+                print(f"Successfully extracted {len(self.downloaded_files)} PDF(s)")
+                
+                # Nothing in memory mode needs the archive after extraction unless a local copy is kept
+                if self.upload_from_memory and not self.keep_local_copy:
+                    archive_path.unlink(missing_ok=True)
+
+            except Exception as e:
+                error_msg = f"Error extracting ZIP file: {e}"
+                print(error_msg)
+                self.errors.append(error_msg)
+        else:
+            # Single PDF file
+            clean_filename = suggested_filename.replace('-', '_')
+            temp_filepath = date_folder / clean_filename
+            if temp_filepath != archive_path:
+                archive_path.replace(temp_filepath)
+
+            self.downloaded_files.append(temp_filepath)
+            print(f"  - Downloaded: {clean_filename}")
+            if self.upload_pipeline:
+                self.upload_pipeline.submit(temp_filepath)
+    
     def _get_graph_token(self):
         """Get Microsoft Graph API access token (shared for SharePoint and Email)"""
         try:
-            import msal
+            import msal  # noqa: F401 - checked here so a missing install is reported clearly
             
-            tenant_id = os.getenv('SHAREPOINT_TENANT_ID')
-            client_id = os.getenv('SHAREPOINT_CLIENT_ID')
-            client_secret = os.getenv('SHAREPOINT_CLIENT_SECRET')
+            tenant_id, client_id, client_secret = self.graph_credentials
             
             # Validate configuration
             if not all([tenant_id, client_id, client_secret]):
@@ -340,37 +2220,474 @@ class WaterReportAutomation:
                 self.errors.append(error_msg)
                 return None
             
-            # Authenticate using MSAL
-            authority = f"https://login.microsoftonline.com/{tenant_id}"
-            scope = ["https://graph.microsoft.com/.default"]
+            # Tokens are cached process-wide (and on disk) until just before they expire
+            provider = GraphTokenProvider.for_credentials(tenant_id, client_id, client_secret)
+            result = provider.acquire()
             
-            app = msal.ConfidentialClientApplication(
-                client_id,
-                authority=authority,
-                client_credential=client_secret
-            )
+            if "access_token" not in result:
+                error_msg = f"Failed to acquire access token: {result.get('error_description', 'Unknown error')}"
+                print(error_msg)
+                self.errors.append(error_msg)
+                return None
+            
+            return result["access_token"]
+            
+        except ImportError:
+            error_msg = "MSAL library not installed. Run: pip install msal"
+            print(error_msg)
+            self.errors.append(error_msg)
+            return None
+        except Exception as e:
+            error_msg = f"Authentication error: {str(e)}"
+            print(error_msg)
+            self.errors.append(error_msg)
+            return None
+    
+    def _sharepoint_target_key(self):
+        return f"{self.sharepoint_site}|{self.sharepoint_folder or ''}"
+    
+    def _resolve_sharepoint_ids(self, graph, access_token, refresh=False):
+        """Return {'site_id', 'drive_id', 'folder_id'} for the configured SharePoint target
+        
+        Served from the local id cache while it is fresh; refresh=True (used after a
+        404 / itemNotFound) drops the cached entry and asks Graph again.
+        """
+        cache_key = self._sharepoint_target_key()
+        if refresh:
+            self.sharepoint_ids.remove(cache_key)
+        else:
+            cached = self.sharepoint_ids.get(cache_key)
+            if cached:
+                print("Using cached SharePoint site and library ids")
+                return cached
+        
+        # Get configuration
+        site_url = self.sharepoint_site
+        folder_path = self.sharepoint_folder
+        
+        if not site_url:
+            error_msg = "SharePoint site URL not configured"
+            print(error_msg)
+            self.errors.append(error_msg)
+            return None
+        
+        # Extract site details from URL
+        # Format: https://tenant.sharepoint.com/sites/sitename
+        try:
+            parsed_url = urlparse(site_url)
+            hostname = parsed_url.netloc  # tenant.sharepoint.com
+            site_path = parsed_url.path   # /sites/sitename
+            
+            # Extract tenant name and site name
+            if '/sites/' in site_path:
+                site_name = site_path.split('/sites/')[-1].strip('/')
+            else:
+                site_name = site_path.strip('/')
             
-            # Acquire token
-            result = app.acquire_token_for_client(scopes=scope)
+        except Exception as e:
+            error_msg = f"Invalid SharePoint site URL format: {str(e)}"
+            print(error_msg)
+            self.errors.append(error_msg)
+            return None
+        
+        # Get site ID
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        
+        # Get site by hostname and path
+        site_api_url = f"https://graph.microsoft.com/v1.0/sites/{hostname}:{site_path}"
+        response = graph.get(site_api_url, headers=headers)
+        
+        if response.status_code != 200:
+            error_msg = f"Failed to get site information: HTTP {response.status_code} - {response.text}"
+            print(error_msg)
+            self.errors.append(error_msg)
+            return None
+        
+        site_id = response.json()['id']
+        print(f"Found SharePoint site: {site_name}")
+        
+        # Get drive (document library)
+        drive_api_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive"
+        response = graph.get(drive_api_url, headers=headers)
+        
+        if response.status_code != 200:
+            error_msg = f"Failed to get document library: HTTP {response.status_code} - {response.text}"
+            print(error_msg)
+            self.errors.append(error_msg)
+            return None
+        
+        drive_id = response.json()['id']
+        print(f"Found document library")
+        
+        # Get the target folder's item id (it is created by the first upload if missing)
+        folder_id = None
+        if folder_path:
+            folder_api_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:/{folder_path}"
+            response = graph.get(folder_api_url, headers=headers)
+            if response.status_code == 200:
+                folder_id = response.json()['id']
+        
+        ids = {
+            'site_id': site_id,
+            'drive_id': drive_id,
+            'folder_id': folder_id,
+            'folder_path': folder_path,
+            'resolved_at': datetime.now().isoformat()
+        }
+        # Only cache a complete resolution, so a missing folder is looked up again next time
+        if folder_id or not folder_path:
+            self.sharepoint_ids.put(cache_key, ids)
+        return ids
+    
+    @staticmethod
+    def _drive_item_url(ids, filename):
+        """Graph URL (without the trailing action) of a file in the target folder"""
+        base = f"https://graph.microsoft.com/v1.0/drives/{ids['drive_id']}"
+        if ids.get('folder_id'):
+            return f"{base}/items/{ids['folder_id']}:/{filename}:"
+        upload_path = f"{ids['folder_path']}/{filename}" if ids.get('folder_path') else filename
+        return f"{base}/root:/{upload_path}:"
+    
+    def _upload_in_chunks(self, graph, item_url, access_token, filepath, restarted=False):
+        """Upload a large file through a Graph upload session, resuming a saved one if possible
+        
+        Returns the response of the final chunk (200/201 with the drive item).
+        """
+        size = filepath.stat().st_size
+        sha256 = hashlib.sha256()
+        with filepath.open('rb') as f:
+            for block in iter(lambda: f.read(self.stream_chunk_size), b''):
+                sha256.update(block)
+        key = f"{item_url}:{size}:{sha256.hexdigest()}"
+        
+        # Resume from the last acknowledged byte if an earlier attempt left a session behind
+        offset = 0
+        saved = self.upload_sessions.get(key)
+        upload_url = saved['upload_url'] if saved else None
+        if upload_url:
+            status = graph.get(upload_url)
+            if status.status_code == 200:
+                offset = self._next_expected_offset(status.json(), size)
+                print(f"  Resuming upload of {filepath.name} at byte {offset} of {size}")
+            else:
+                # The session expired or was cancelled on the server side
+                self.upload_sessions.remove(key)
+                upload_url = None
+        
+        if not upload_url:
+            session_url = f"{item_url}/createUploadSession"
+            response = graph.post(
+                session_url,
+                headers={'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'},
+                json={'item': {'@microsoft.graph.conflictBehavior': 'replace'}}
+            )
+            if response.status_code != 200:
+                return response
+            session = response.json()
+            upload_url = session['uploadUrl']
+            self.upload_sessions.put(key, {
+                'upload_url': upload_url,
+                'expires': session.get('expirationDateTime'),
+                'next_offset': 0
+            })
+        
+        # The upload URL is pre-authenticated, so no Authorization header on chunk PUTs
+        recoveries = 0
+        with filepath.open('rb') as f:
+            while True:
+                if offset >= size:
+                    # The session already has every byte, so Graph has committed the file:
+                    # fetch the item rather than send an empty, invalid Content-Range
+                    self.upload_sessions.remove(key)
+                    response = graph.get(item_url, headers={'Authorization': f'Bearer {access_token}'})
+                    if response.status_code == 200 or restarted:
+                        return response
+                    # Not there after all: start over once with a fresh session
+                    return self._upload_in_chunks(graph, item_url, access_token, filepath, restarted=True)
+                f.seek(offset)
+                chunk = f.read(self.upload_chunk_size)
+                end = offset + len(chunk) - 1
+                try:
+                    # Never blindly resent: a chunk may have landed even if the reply got lost
+                    response = graph.put(upload_url, idempotent=False, data=chunk, headers={
+                        'Content-Length': str(len(chunk)),
+                        'Content-Range': f"bytes {offset}-{end}/{size}"
+                    })
+                except (requests.ConnectionError, requests.Timeout):
+                    response = None
+                
+                if response is not None and response.status_code in [200, 201]:
+                    self.upload_sessions.remove(key)
+                    return response
+                if response is None or response.status_code >= 500:
+                    # Ask the session which bytes it actually has, then carry on from there
+                    status = graph.get(upload_url) if recoveries < graph.max_retries else None
+                    if status is not None and status.status_code == 200:
+                        recoveries += 1
+                        offset = self._next_expected_offset(status.json(), size)
+                        print(f"  Chunk upload of {filepath.name} failed, resuming at byte {offset}")
+                        continue
+                    if response is None:
+                        raise requests.ConnectionError(f"Upload session for {filepath.name} stopped responding")
+                if response.status_code != 202:
+                    # Keep the session so the next attempt resumes where this one stopped
+                    return response
+                
+                offset = self._next_expected_offset(response.json(), size)
+                self.upload_sessions.put(key, {
+                    'upload_url': upload_url,
+                    'expires': response.json().get('expirationDateTime'),
+                    'next_offset': offset
+                })
+    
+    @staticmethod
+    def _next_expected_offset(session_status, size):
+        """First byte Graph still needs, from an upload session's nextExpectedRanges"""
+        ranges = session_status.get('nextExpectedRanges') or [f"{size}-"]
+        return int(ranges[0].split('-')[0])
+    
+    def _drive_item_path(self, ids, filename):
+        """Graph path (relative to /v1.0) of a file in the target folder, for $batch use"""
+        from urllib.parse import quote
+        return self._drive_item_url(ids, quote(filename))[len("https://graph.microsoft.com/v1.0"):].rstrip(':')
+    
+    def _sync_sharepoint_index(self, graph, ids, access_token):
+        """Refresh the local folder index with a delta query; False if it can't be used"""
+        if not self.sharepoint_index or not ids.get('folder_id'):
+            return False
+        try:
+            changes = self.sharepoint_index.sync(graph, access_token, ids['drive_id'], ids['folder_id'])
+            print(f"SharePoint folder index up to date ({changes} change(s) applied)")
+            return True
+        except Exception as e:
+            print(f"Could not sync the SharePoint folder index, checking files directly: {e}")
+            return False
+    
+    def _check_existing_files(self, graph, ids, access_token, filepaths):
+        """Look up which files already exist in the target folder
+        
+        Uses the delta-synced local index when it is available, otherwise asks
+        Graph in $batch round trips. Returns {filename: drive item dict} for the
+        files that exist.
+        """
+        if self._sync_sharepoint_index(graph, ids, access_token):
+            self.index_synced = True
+            return self.sharepoint_index.lookup(ids['folder_id'], [filepath.name for filepath in filepaths])
+        
+        batch = GraphBatch()
+        request_ids = {}
+        for filepath in filepaths:
+            path = self._drive_item_path(ids, filepath.name)
+            request_ids[filepath.name] = batch.add(
+                'GET', f"{path}?$select=id,name,size,file,webUrl,lastModifiedDateTime"
+            )
+        
+        results = batch.execute(graph, access_token)
+        existing = {}
+        for name, request_id in request_ids.items():
+            result = results.get(request_id, {})
+            if result.get('status') == 200:
+                existing[name] = result['body']
+            elif result.get('status') != 404:
+                print(f"  Could not check {name} in SharePoint: HTTP {result.get('status')}")
+        return existing
+    
+    def _metadata_for_file(self, filename):
+        """Sample id and report date to tag an uploaded file with
+        
+        The sample id is the report id of the grid row it belongs to (matched as a
+        whole token of the name), else the file name without extension; the date
+        is the first date in that row, else the end of the requested range. Dates
+        are ISO 8601, as SharePoint DateTime columns expect.
+        """
+        stem = Path(filename).stem
+        for row in self.selected_rows:
+            if row.report_id and self._report_in_filename(row.report_id, filename):
+                return row.report_id, self._iso_date(self._row_date(row) or self.date_range[1])
+        return stem, self._iso_date(self.date_range[1])
+    
+    @staticmethod
+    def _report_in_filename(report_id, filename):
+        """True if the report id is a whole delimited token of the file name,
+        so report 12 is not found inside file 112_..."""
+        def normalize(text):
+            return re.sub(r'[^0-9a-z]+', '_', text.lower()).strip('_')
+        
+        pattern = r'(?:^|_)' + re.escape(normalize(report_id)) + r'(?:_|$)'
+        return re.search(pattern, normalize(Path(filename).stem)) is not None
+    
+    @staticmethod
+    def _row_date(row):
+        """First date in a grid row, as YYYY-MM-DD (None if the row has none)"""
+        for cell in row.cells:
+            match = re.search(r'\b(\d{1,2}/\d{1,2}/\d{4}|\d{4}-\d{2}-\d{2})\b', cell)
+            if match:
+                value = match.group(1)
+                fmt = '%m/%d/%Y' if '/' in value else '%Y-%m-%d'
+                try:
+                    return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+                except ValueError:
+                    continue
+        return None
+    
+    @staticmethod
+    def _iso_date(value):
+        """YYYY-MM-DD as an ISO 8601 timestamp, as SharePoint DateTime columns expect"""
+        if not value:
+            return None
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%dT00:00:00Z')
+    
+    def _tag_uploaded_files(self, graph, access_token, results):
+        """Set the sample id / report date list-item fields on uploaded files, batched"""
+        if not (self.metadata_sample_field or self.metadata_date_field):
+            return
+        
+        batch = GraphBatch()
+        request_ids = {}
+        for result in results:
+            if not result['ok'] or not result.get('item_id'):
+                continue
+            sample_id, report_date = self._metadata_for_file(result['name'])
+            fields = {}
+            if self.metadata_sample_field:
+                fields[self.metadata_sample_field] = sample_id
+            if self.metadata_date_field and report_date:
+                fields[self.metadata_date_field] = report_date
+            request_ids[result['name']] = batch.add(
+                'PATCH', f"/drives/{result['drive_id']}/items/{result['item_id']}/listItem/fields", body=fields
+            )
+        
+        if not request_ids:
+            return
+        print(f"Tagging {len(request_ids)} file(s) with report metadata...")
+        responses = batch.execute(graph, access_token)
+        for name, request_id in request_ids.items():
+            response = responses.get(request_id, {})
+            if response.get('status') != 200:
+                # The file itself is in SharePoint, so this must not hold back the ledger
+                print(f"Warning: could not set metadata on {name}: HTTP {response.get('status')} - {response.get('body')}")
+    
+    def _upload_file(self, graph, ids, access_token, filepath):
+        """Upload one file to the SharePoint folder, returning a result record
+        
+        Runs on an upload worker thread, so it only reports back and never
+        touches the shared result lists itself.
+        """
+        result = {'name': filepath.name, 'ok': False, 'web_url': '', 'error': None, 'not_found': False, 'seconds': 0.0}
+        if self.cancelled.is_set():
+            # Queue worker lost its lease: the reports now belong to another worker
+            result['error'] = f"Upload of {filepath.name} cancelled"
+            return result
+        started = time.monotonic()
+        try:
+            print(f"Uploading {filepath.name} to SharePoint...")
             
-            if "access_token" not in result:
-                error_msg = f"Failed to acquire access token: {result.get('error_description', 'Unknown error')}"
-                print(error_msg)
-                self.errors.append(error_msg)
-                return None
+            # Construct upload URL
+            # Format: /drives/{drive-id}/items/{folder-id}:/{filename}:/content
+            item_url = self._drive_item_url(ids, filepath.name)
+            upload_url = f"{item_url}/content"
             
-            return result["access_token"]
+            # Graph's simple PUT is capped at 4 MB, larger files go through an upload session
+            if filepath.stat().st_size > self.upload_session_threshold:
+                response = self._upload_in_chunks(graph, item_url, access_token, filepath)
+            else:
+                # Read file content
+                with filepath.open('rb') as f:
+                    file_content = f.read()
+                
+                # Upload file
+                upload_headers = {
+                    'Authorization': f'Bearer {access_token}',
+                    'Content-Type': 'application/pdf'
+                }
+                
+                response = graph.put(upload_url, headers=upload_headers, data=file_content)
+            
+            if response.status_code in [200, 201]:
+                # Extract the webUrl from the response to create a direct link
+                response_data = response.json()
+                result['web_url'] = response_data.get('webUrl', '')
+                result['item_id'] = response_data.get('id')
+                result['drive_id'] = ids['drive_id']
+                result['ok'] = True
+                print(f"  Successfully uploaded: {filepath.name}")
+                if self.sharepoint_index and ids.get('folder_id') and response_data.get('id'):
+                    # The file is in SharePoint either way; a stale index only costs a lookup later
+                    try:
+                        self.sharepoint_index.record_upload(ids['folder_id'], response_data)
+                    except Exception as e:
+                        print(f"  Warning: could not record {filepath.name} in the SharePoint index: {e}")
+            else:
+                result['error'] = f"Error uploading {filepath.name}: HTTP {response.status_code} - {response.text}"
+                result['not_found'] = response.status_code == 404 or 'itemNotFound' in response.text
+                print(result['error'])
             
-        except ImportError:
-            error_msg = "MSAL library not installed. Run: pip install msal"
-            print(error_msg)
-            self.errors.append(error_msg)
-            return None
         except Exception as e:
-            error_msg = f"Authentication error: {str(e)}"
-            print(error_msg)
-            self.errors.append(error_msg)
+            result['error'] = f"Error uploading {filepath.name}: {str(e)}"
+            print(result['error'])
+        
+        result['seconds'] = round(time.monotonic() - started, 3)
+        return result
+    
+    def _connect_sharepoint(self):
+        """Authenticate and resolve the SharePoint target, returning (graph, ids, token) or None"""
+        print(f"Connecting to SharePoint via Microsoft Graph API...")
+        
+        # Get access token
+        access_token = self._get_graph_token()
+        if not access_token:
+            return None
+        
+        print("Successfully authenticated with Microsoft Graph API")
+        
+        graph = get_graph_scheduler(self.graph_credentials[0])
+        ids = self._resolve_sharepoint_ids(graph, access_token)
+        if not ids:
             return None
+        return graph, ids, access_token
+    
+    def _unchanged_in_sharepoint(self, filepath, item):
+        """Skip record if the drive item is byte-identical to the local file, else None"""
+        remote_hash = ((item or {}).get('file') or {}).get('hashes', {}).get('quickXorHash')
+        size = filepath.stat().st_size
+        if remote_hash and item.get('size') == size and \
+                QuickXorHash.of_file(filepath, self.stream_chunk_size) == remote_hash:
+            print(f"  Unchanged in SharePoint, skipping: {filepath.name}")
+            return {'name': filepath.name, 'skipped': True, 'bytes': size, 'web_url': item.get('webUrl', '')}
+        return None
+    
+    def _record_upload_results(self, graph, access_token, results):
+        """Tag uploaded files and fold per-file results into the run's lists, in order"""
+        # Tag the uploaded files with their sample id / report date, batched
+        self._tag_uploaded_files(graph, access_token, [result for result in results if not result.get('skipped')])
+        
+        for result in results:
+            if result.get('skipped'):
+                self.skipped_files.append({key: result[key] for key in ('name', 'bytes', 'web_url')})
+                continue
+            self.upload_stats.append(result)
+            if result['ok']:
+                self.uploaded_files.append(result['name'])
+                # Store the URL for this file
+                if result['web_url']:
+                    self.uploaded_files_urls[result['name']] = result['web_url']
+            else:
+                self.errors.append(result['error'])
+        
+        # In-memory reports are no longer needed once they are in SharePoint; failed ones
+        # keep their bytes so they can still be retried
+        delivered = {result['name'] for result in results if result.get('ok') or result.get('skipped')}
+        for filepath in self.downloaded_files:
+            if isinstance(filepath, InMemoryReport) and filepath.name in delivered:
+                filepath.release()
+        
+        print(f"Successfully uploaded {len(self.uploaded_files)} file(s) to SharePoint")
+        if self.skipped_files:
+            saved = sum(skipped['bytes'] for skipped in self.skipped_files)
+            print(f"Skipped {len(self.skipped_files)} unchanged file(s), {saved} bytes not re-sent")
     
     def upload_to_sharepoint(self):
         """Upload downloaded PDFs to SharePoint using Microsoft Graph API"""
@@ -379,122 +2696,53 @@ class WaterReportAutomation:
             return
         
         try:
-            print(f"Connecting to SharePoint via Microsoft Graph API...")
-            
-            # Get access token
-            access_token = self._get_graph_token()
-            if not access_token:
+            connection = self._connect_sharepoint()
+            if not connection:
                 return
-            
-            print("Successfully authenticated with Microsoft Graph API")
-            
-            # Get configuration
-            site_url = self.sharepoint_site
-            folder_path = self.sharepoint_folder
-            
-            if not site_url:
-                error_msg = "SharePoint site URL not configured"
-                print(error_msg)
-                self.errors.append(error_msg)
-                return
-            
-            # Extract site details from URL
-            # Format: https://tenant.sharepoint.com/sites/sitename
-            try:
-                from urllib.parse import urlparse
-                parsed_url = urlparse(site_url)
-                hostname = parsed_url.netloc  # tenant.sharepoint.com
-                site_path = parsed_url.path   # /sites/sitename
+            graph, ids, access_token = connection
+            
+            # Check what is already in the target folder, 20 files per round trip
+            existing = self._check_existing_files(graph, ids, access_token, self.downloaded_files)
+            
+            # Skip files that are byte-identical to what SharePoint already has
+            results = [
+                self._unchanged_in_sharepoint(filepath, existing.get(filepath.name))
+                for filepath in self.downloaded_files
+            ]
+            pending = [i for i, result in enumerate(results) if result is None]
+            
+            replaced = sum(1 for i in pending if self.downloaded_files[i].name in existing)
+            if replaced:
+                print(f"{replaced} file(s) already exist in SharePoint and will be replaced")
+            
+            # Upload the files concurrently, then record results in the original order
+            from concurrent.futures import ThreadPoolExecutor
+            
+            def upload(i):
+                filepath = self.downloaded_files[i]
+                result = self._upload_file(graph, ids, access_token, filepath)
+                if result['ok'] and isinstance(filepath, InMemoryReport):
+                    filepath.release()  # Free memory file by file, not at the end of the run
+                return result
+            
+            workers = max(1, min(self.upload_concurrency, len(pending)))
+            print(f"Uploading {len(pending)} file(s) with {workers} worker(s)...")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                uploaded = executor.map(upload, pending)
+                for i, result in zip(pending, list(uploaded)):
+                    results[i] = result
                 
-                # Extract tenant name and site name
-                if '/sites/' in site_path:
-                    site_name = site_path.split('/sites/')[-1].strip('/')
-                else:
-                    site_name = site_path.strip('/')
-                
-            except Exception as e:
-                error_msg = f"Invalid SharePoint site URL format: {str(e)}"
-                print(error_msg)
-                self.errors.append(error_msg)
-                return
-            
-            # Get site ID
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # Get site by hostname and path
-            site_api_url = f"https://graph.microsoft.com/v1.0/sites/{hostname}:{site_path}"
-            response = requests.get(site_api_url, headers=headers)
-            
-            if response.status_code != 200:
-                error_msg = f"Failed to get site information: HTTP {response.status_code} - {response.text}"
-                print(error_msg)
-                self.errors.append(error_msg)
-                return
-            
-            site_id = response.json()['id']
-            print(f"Found SharePoint site: {site_name}")
-            
-            # Get drive (document library)
-            drive_api_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive"
-            response = requests.get(drive_api_url, headers=headers)
-            
-            if response.status_code != 200:
-                error_msg = f"Failed to get document library: HTTP {response.status_code} - {response.text}"
-                print(error_msg)
-                self.errors.append(error_msg)
-                return
-            
-            drive_id = response.json()['id']
-            print(f"Found document library")
-            
-            # Upload each file
-            for filepath in self.downloaded_files:
-                try:
-                    print(f"Uploading {filepath.name} to SharePoint...")
-                    
-                    # Construct upload URL
-                    # Format: /drives/{drive-id}/root:/{folder-path}/{filename}:/content
-                    upload_path = f"{folder_path}/{filepath.name}" if folder_path else filepath.name
-                    upload_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:/{upload_path}:/content"
-                    
-                    # Read file content
-                    with open(filepath, 'rb') as f:
-                        file_content = f.read()
-                    
-                    # Upload file
-                    upload_headers = {
-                        'Authorization': f'Bearer {access_token}',
-                        'Content-Type': 'application/pdf'
-                    }
-                    
-                    response = requests.put(upload_url, headers=upload_headers, data=file_content)
-                    
-                    if response.status_code in [200, 201]:
-                        self.uploaded_files.append(filepath.name)
-                        
-                        # Extract the webUrl from the response to create a direct link
-                        response_data = response.json()
-                        web_url = response_data.get('webUrl', '')
-                        
-                        # Store the URL for this file
-                        if web_url:
-                            self.uploaded_files_urls[filepath.name] = web_url
-                        
-                        print(f"  Successfully uploaded: {filepath.name}")
-                    else:
-                        error_msg = f"Error uploading {filepath.name}: HTTP {response.status_code} - {response.text}"
-                        print(error_msg)
-                        self.errors.append(error_msg)
-                    
-                except Exception as e:
-                    error_msg = f"Error uploading {filepath.name}: {str(e)}"
-                    print(error_msg)
-                    self.errors.append(error_msg)
-            
-            print(f"Successfully uploaded {len(self.uploaded_files)} file(s) to SharePoint")
+                # A 404 means the cached site/drive/folder ids went stale: re-resolve and retry those files once
+                stale = [i for i in pending if results[i].get('not_found')]
+                if stale:
+                    print("SharePoint target not found with cached ids, resolving again...")
+                    ids = self._resolve_sharepoint_ids(graph, access_token, refresh=True)
+                    if ids:
+                        retried = list(executor.map(upload, stale))
+                        for i, result in zip(stale, retried):
+                            results[i] = result
+            
+            self._record_upload_results(graph, access_token, results)
             
         except Exception as e:
             error_msg = f"SharePoint Graph API error: {str(e)}"
@@ -504,8 +2752,8 @@ class WaterReportAutomation:
     def send_notification_email(self):
         """Send email notification about the automation results using Microsoft Graph API"""
         try:
-            email_sender = os.getenv('EMAIL_SENDER_ADDRESS')
-            email_to = os.getenv('EMAIL_TO')
+            email_sender = self.email_sender
+            email_to = self.email_to
             
             if not email_sender or not email_to:
                 error_msg = "Email configuration missing. Please set EMAIL_SENDER_ADDRESS and EMAIL_TO in .env"
@@ -520,7 +2768,7 @@ class WaterReportAutomation:
                 return
             
             # Determine status
-            if not self.errors and self.downloaded_files and len(self.uploaded_files) == len(self.downloaded_files):
+            if not self.errors and self.downloaded_files and self._all_files_delivered():
                 status = "SUCCESS"
                 subject = "✅ Water Reports Automation - Success"
                 status_color = "#28a745"  # Green
@@ -528,7 +2776,7 @@ class WaterReportAutomation:
                 status = "NO REPORTS FOUND"
                 subject = "ℹ️ Water Reports Automation - No Reports Found"
                 status_color = "#17a2b8"  # Blue
-            elif self.downloaded_files and self.uploaded_files:
+            elif self.downloaded_files and (self.uploaded_files or self.skipped_files):
                 status = "PARTIAL SUCCESS"
                 subject = "⚠️ Water Reports Automation - Partial Success"
                 status_color = "#ffc107"  # Yellow
@@ -568,6 +2816,22 @@ class WaterReportAutomation:
             else:
                 uploaded_list = "&nbsp;&nbsp;None"
             
+            # Files that were already in SharePoint with identical content
+            if self.skipped_files:
+                skipped_items = []
+                for i, skipped in enumerate(self.skipped_files):
+                    clean_name = clean_filename(skipped['name'])
+                    if skipped['web_url']:
+                        skipped_items.append(
+                            f'&nbsp;&nbsp;{i+1}. <a href="{skipped["web_url"]}" style="color: #007bff; text-decoration: none;">{clean_name}</a>'
+                        )
+                    else:
+                        skipped_items.append(f"&nbsp;&nbsp;{i+1}. {clean_name}")
+                skipped_list = "<br>".join(skipped_items)
+            else:
+                skipped_list = "&nbsp;&nbsp;None"
+            skipped_bytes = sum(skipped['bytes'] for skipped in self.skipped_files)
+            
             error_list = "<br>".join(
                 f"&nbsp;&nbsp;• {e}" 
                 for e in self.errors
@@ -609,6 +2873,11 @@ class WaterReportAutomation:
                             {uploaded_list}
                         </div>
                         
+                        <div class="section">
+                            <div class="section-title">Unchanged in SharePoint, not re-uploaded ({len(self.skipped_files)}, {skipped_bytes / (1024 * 1024):.1f} MB saved):</div>
+                            {skipped_list}
+                        </div>
+                        
                         <div class="section">
                             <div class="section-title">Errors ({len(self.errors)}):</div>
                             {error_list}
@@ -637,9 +2906,10 @@ class WaterReportAutomation:
                     "toRecipients": [
                         {
                             "emailAddress": {
-                                "address": email_to
+                                "address": address.strip()
                             }
                         }
+                        for address in email_to.split(',') if address.strip()
                     ]
                 },
                 "saveToSentItems": "true"
@@ -653,7 +2923,7 @@ class WaterReportAutomation:
             }
             
             send_mail_url = f"https://graph.microsoft.com/v1.0/users/{sender_email}/sendMail"
-            response = requests.post(send_mail_url, headers=headers, json=email_data)
+            response = get_graph_scheduler(self.graph_credentials[0]).post(send_mail_url, headers=headers, json=email_data)
             
             if response.status_code == 202:
                 print("Notification email sent successfully!")
@@ -667,76 +2937,765 @@ class WaterReportAutomation:
             print(error_msg)
             self.errors.append(error_msg)
     
-    async def run(self):
-        """Main execution method"""
-        print("=" * 60)
-        print("Meras Water Report Automation")
-        print("=" * 60)
-        print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print()
+    async def launch_browser(self, playwright):
+        """Launch the browser used for portal sessions, as configured by BROWSER_PROFILE"""
+        return await launch_browser(playwright, self.browser_profile)
+    
+    async def _block_unneeded_requests(self, route):
+        """Abort images, fonts, media and analytics; let everything else through"""
+        request = route.request
+        host = urlparse(request.url).hostname or ''
+        if (request.resource_type in BLOCKED_RESOURCE_TYPES
+                or any(host == domain or host.endswith('.' + domain) for domain in BLOCKED_DOMAINS)):
+            self.blocked_requests += 1
+            await route.abort()
+        else:
+            await route.continue_()
+    
+    async def new_portal_context(self, browser):
+        """Open a browser context, preloaded with the saved portal session if there is one"""
+        # Reuse the authenticated cookies/ASP.NET session from the last run if we have them
+        if self.saved_session is None:
+            self.saved_session = self.session_store.load()
+        storage_state = self.saved_session['storage_state'] if self.saved_session else None
         
-        async with async_playwright() as p:
-            # Create a date-specific download folder
-            today_str = datetime.now().strftime('%Y-%m-%d')
-            date_folder = self.download_path / today_str
-            date_folder.mkdir(parents=True, exist_ok=True)
-            
-            # Launch browser - using system Chrome instead of Chromium
-            browser = await p.chromium.launch(
-                channel='chrome',  # Use system Chrome browser
-                headless=False,  # Running with visible browser
-                slow_mo=100,  # Slow down by 100ms to improve stability
-                args=['--start-maximized']  # Launch in maximized window
-            )
-            
-            context = await browser.new_context(
+        if self.browser_profile == 'debug':
+            return await browser.new_context(
                 accept_downloads=True,
-                no_viewport=True  # Use full window size instead of fixed viewport
+                no_viewport=True,  # Use full window size instead of fixed viewport
+                storage_state=storage_state
             )
-            
+        
+        context = await browser.new_context(
+            accept_downloads=True,
+            viewport={'width': 1920, 'height': 1080},  # Same layout as the maximized debug window
+            storage_state=storage_state
+        )
+        await context.route('**/*', self._block_unneeded_requests)
+        return context
+    
+    async def download_in_context(self, browser, context=None):
+        """Login and download reports in a context of an already running browser
+        
+        A context that is passed in (kept warm by the daemon) is reused and left
+        open; otherwise a fresh one is created and closed afterwards.
+        """
+        owned = context is None
+        if owned:
+            context = await self.new_portal_context(browser)
+        page = None
+        try:
             page = await context.new_page()
             
-            # Set up CDP session to configure download behavior
-            cdp = await context.new_cdp_session(page)
-            await cdp.send('Browser.setDownloadBehavior', {
-                'behavior': 'allow',
-                'downloadPath': str(date_folder)
-            })
-            
+            # Login (or resume the saved session), then filter and download
+            if await self.ensure_logged_in(page):
+                await self.filter_and_download_reports(page)
+        
+        finally:
+            if owned:
+                await context.close()
+            elif page is not None:
+                await page.close()
+    
+    async def run_browser_session(self, context=None):
+        """Login and download reports with Playwright, in a warm context if one is given"""
+        if context is not None:
+            await self.download_in_context(context.browser, context)
+            return
+        
+        async with async_playwright() as p:
+            browser = await self.launch_browser(p)
             try:
-                # Step 1: Login
-                if await self.login_to_portal(page):
-                    # Step 2: Filter and download reports
-                    await self.filter_and_download_reports(page)
-                    
-                    # Step 3: Upload to SharePoint
-                    if self.downloaded_files:
-                        self.upload_to_sharepoint()
+                await self.download_in_context(browser)
+            finally:
+                await browser.close()
+    
+    def close(self):
+        """Release the local state databases"""
+        self.ledger.close()
+        if self.sharepoint_index:
+            self.sharepoint_index.close()
+    
+    @staticmethod
+    def _backfill_windows(start_date, end_date, window_days):
+        """Split an inclusive YYYY-MM-DD range into consecutive windows of window_days"""
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+        windows = []
+        while start <= end:
+            window_end = min(start + timedelta(days=window_days - 1), end)
+            windows.append((start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+            start = window_end + timedelta(days=1)
+        return windows
+    
+    async def _download_window(self, browser, window, semaphore):
+        """Download one backfill window in its own context, retrying it on failure"""
+        async with semaphore:
+            worker = None
+            for attempt in range(1, self.backfill_retries + 2):
+                # A fresh worker per attempt so a failed attempt leaves nothing behind
+                if worker is not None:
+                    worker.close()  # Its ledger/index connections; results stay readable
+                worker = WaterReportAutomation()
+                worker.fixed_date_range = window
+                worker.saved_session = self.saved_session
+                worker.download_path = self.download_path / 'backfill' / f"{window[0]}_{window[1]}"
+                worker.download_path.mkdir(parents=True, exist_ok=True)
                 
-            except Exception as e:
-                error_msg = f"Unexpected error: {str(e)}"
-                print(error_msg)
-                self.errors.append(error_msg)
+                print(f"[{window[0]} .. {window[1]}] attempt {attempt}")
+                try:
+                    await worker.download_in_context(browser)
+                except Exception as e:
+                    worker.errors.append(f"Unexpected error: {str(e)}")
+                
+                if not worker.errors:
+                    break
+                print(f"[{window[0]} .. {window[1]}] failed: {'; '.join(worker.errors)}")
             
+            worker.close()
+            return window, worker
+    
+    async def download_backfill(self, start_date, end_date):
+        """Download a long date range as parallel per-window browser contexts
+        
+        Each window (BACKFILL_WINDOW_DAYS long) runs in its own context of one
+        shared browser, at most BACKFILL_PARALLEL at a time, and is retried up to
+        BACKFILL_RETRIES times. Files from every window that succeeded feed the
+        normal upload step; a failed window only contributes its errors.
+        """
+        windows = self._backfill_windows(start_date, end_date, self.backfill_window_days)
+        print(f"Backfilling {start_date} to {end_date} in {len(windows)} window(s), "
+              f"{self.backfill_parallel} in parallel")
+        self.date_range = (start_date, end_date)
+        
+        async with async_playwright() as p:
+            browser = await self.launch_browser(p)
+            try:
+                # Log in once up front so every window context starts authenticated
+                if not self.session_store.load():
+                    context = await browser.new_context(accept_downloads=True)
+                    try:
+                        if not await self.login_to_portal(await context.new_page()):
+                            return
+                    finally:
+                        await context.close()
+                self.saved_session = self.session_store.load()
+                
+                semaphore = asyncio.Semaphore(self.backfill_parallel)
+                results = await asyncio.gather(
+                    *(self._download_window(browser, window, semaphore) for window in windows)
+                )
             finally:
                 await browser.close()
         
+        for window, worker in results:
+            label = f"{window[0]} .. {window[1]}"
+            self.window_results.append({
+                'window': window,
+                'rows': worker.selected_rows,
+                'files': list(worker.downloaded_files),
+                'ok': not worker.errors
+            })
+            self.download_stats.extend(worker.download_stats)
+            self.stream_stats.extend(worker.stream_stats)
+            self.waits.timings.extend(worker.waits.timings)
+            self.blocked_requests += worker.blocked_requests
+            if worker.errors:
+                self.errors.extend(f"[{label}] {error}" for error in worker.errors)
+            else:
+                self.downloaded_files.extend(worker.downloaded_files)
+                self.selected_rows.extend(worker.selected_rows)
+        
+        failed = [result['window'] for result in self.window_results if not result['ok']]
+        print(f"Backfill finished: {len(windows) - len(failed)} window(s) ok, {len(failed)} failed")
+    
+    async def run(self, backfill=None, context=None, notify=True):
+        """Main execution method
+        
+        backfill: optional (start, end) YYYY-MM-DD range to re-pull in parallel windows
+        context: optional warm browser context to use instead of launching a browser
+        notify: False when the caller sends the results itself (polling digest)
+        """
+        print("=" * 60)
+        print("Meras Water Report Automation")
+        print("=" * 60)
+        print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        print()
+        
+        try:
+            # Step 1 + 2: Login, filter and download reports
+            handled = False
+            if self.upload_from_memory and self.keep_local_copy:
+                # The local archive is written on the side, never in the upload's way
+                from concurrent.futures import ThreadPoolExecutor
+                self.local_copy_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='local-copy')
+            if self.pipeline_uploads and not backfill:
+                # Uploads start as soon as the first PDF is extracted
+                self.upload_pipeline = UploadPipeline(
+                    self, self.upload_concurrency, max_queued=self.upload_concurrency * 2
+                )
+            if backfill:
+                await self.download_backfill(*backfill)
+                handled = True
+            elif self.portal_engine == 'http':
+                handled = await self.filter_and_download_reports_http()
+            if not handled:
+                await self.run_browser_session(context)
+            
+            # Step 3: Upload to SharePoint
+            if self.upload_pipeline:
+                pipeline, self.upload_pipeline = self.upload_pipeline, None
+                results = await asyncio.to_thread(pipeline.finish)
+                if pipeline.connection:
+                    graph, _, access_token = pipeline.connection
+                    self._record_upload_results(graph, access_token, results)
+            elif self.downloaded_files:
+                # Synchronous Graph calls, kept off the event loop
+                await asyncio.to_thread(self.upload_to_sharepoint)
+            
+            # Remember what was processed so the next run only picks up new reports
+            if self.date_range[1]:
+                self.update_ledger()
+        
+        except asyncio.CancelledError:
+            # Stopped from outside (queue lease lost): drain the pipeline's queued uploads as cancelled
+            self.cancelled.set()
+            if self.upload_pipeline:
+                threading.Thread(target=self.upload_pipeline.finish, daemon=True).start()
+            raise
+        except Exception as e:
+            error_msg = f"Unexpected error: {str(e)}"
+            print(error_msg)
+            self.errors.append(error_msg)
+        
+        if self.local_copy_writer:
+            self.local_copy_writer.shutdown(wait=True)
+            self.local_copy_writer = None
+        
         # Step 4: Send notification
-        self.send_notification_email()
+        if notify:
+            self.send_notification_email()
         
         print()
         print("=" * 60)
         print(f"End time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"Total files downloaded: {len(self.downloaded_files)}")
         print(f"Total files uploaded: {len(self.uploaded_files)}")
+        if self.skipped_files:
+            print(f"Total files skipped (unchanged): {len(self.skipped_files)}, "
+                  f"{sum(skipped['bytes'] for skipped in self.skipped_files)} bytes saved")
+        if self.upload_stats:
+            latencies = sorted(stat['seconds'] for stat in self.upload_stats)
+            print(f"Upload latency: median {latencies[len(latencies) // 2]:.2f}s, max {latencies[-1]:.2f}s")
+        print(f"Total bytes downloaded: {sum(stat['bytes'] for stat in self.download_stats)}")
         print(f"Total errors: {len(self.errors)}")
+        if self.stream_stats:
+            streamed_bytes = sum(stat['bytes'] for stat in self.stream_stats)
+            streamed_seconds = sum(stat['seconds'] for stat in self.stream_stats)
+            rate = streamed_bytes / streamed_seconds / (1024 * 1024) if streamed_seconds else 0.0
+            print(f"Streamed {len(self.stream_stats)} file(s), {streamed_bytes} bytes at {rate:.2f} MB/s")
+        if self.blocked_requests:
+            print(f"Blocked browser requests (images/fonts/media/analytics): {self.blocked_requests}")
+        if self.http.summary():
+            print("HTTP connection pools:")
+            print(self.http.summary())
+            print(get_graph_scheduler(self.graph_credentials[0]).summary())
+        if self.waits.timings:
+            print("Portal wait timings:")
+            print(self.waits.summary())
+        print("=" * 60)
+
+
+class MultiAccountRunner:
+    """Runs several lab accounts concurrently from one shared browser
+    
+    Every account gets its own browser context (cookies, session file, ledger
+    and download folder), at most max_concurrency at a time. Graph tokens and
+    throttling are shared by accounts in the same tenant, HTTP pools by all.
+    """
+    
+    def __init__(self, accounts, max_concurrency=2):
+        self.accounts = accounts
+        self.max_concurrency = max_concurrency
+        self.results = []  # One summary dict per account
+    
+    async def _run_account(self, browser, account, semaphore):
+        async with semaphore:
+            print(f"\n[{account.name}] starting")
+            automation = WaterReportAutomation(account)
+            context = None
+            try:
+                # Also used by the HTTP engine if it has to fall back to the browser
+                context = await automation.new_portal_context(browser)
+                await automation.run(context=context)
+            except Exception as e:
+                automation.errors.append(f"Unexpected error: {str(e)}")
+            finally:
+                if context is not None:
+                    await context.close()
+                automation.close()
+            
+            return {
+                'account': account.name,
+                'downloaded': len(automation.downloaded_files),
+                'uploaded': len(automation.uploaded_files),
+                'skipped': len(automation.skipped_files),
+                'errors': list(automation.errors)
+            }
+    
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with async_playwright() as p:
+            # The browser only depends on BROWSER_PROFILE, not on an account
+            browser = await launch_browser(p)
+            try:
+                self.results = await asyncio.gather(
+                    *(self._run_account(browser, account, semaphore) for account in self.accounts)
+                )
+            finally:
+                await browser.close()
+        
+        print()
+        print("=" * 60)
+        print(f"Accounts: {len(self.results)}")
+        for result in self.results:
+            status = "OK" if not result['errors'] else f"{len(result['errors'])} error(s)"
+            print(f"  {result['account']}: {result['downloaded']} downloaded, {result['uploaded']} uploaded, "
+                  f"{result['skipped']} skipped - {status}")
+        print("=" * 60)
+        return self.results
+
+
+class QueueWorker:
+    """Takes (account, date window) jobs from the shared work queue and runs them
+    
+    Any number of workers, on one host or several, can drain the same queue.
+    Each job runs in its own context of this worker's browser while a heartbeat
+    keeps its lease alive; reports are claimed through the queue so none is
+    uploaded by two workers.
+    """
+    
+    def __init__(self, queue, accounts=None, lease_seconds=300, max_attempts=3, wait=False, idle_seconds=30):
+        from work_queue import worker_id
+        
+        self.queue = queue
+        self.accounts = {account.name: account for account in accounts or []}
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.wait = wait  # Keep waiting for new jobs instead of exiting when the queue is empty
+        self.idle_seconds = idle_seconds
+        self.worker_id = worker_id()
+        self.results = []
+    
+    async def _heartbeat(self, job, lost, run_task, automation):
+        """Renew the lease until cancelled; if it is lost, stop the job's run"""
+        renewed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                if await asyncio.to_thread(self.queue.heartbeat, job, self.lease_seconds):
+                    renewed_at = time.monotonic()
+                    continue
+                print(f"[job {job.job_id}] lease lost to another worker")
+            except Exception as e:
+                # e.g. 'database is locked': try again, unless the lease may already have run out
+                print(f"[job {job.job_id}] heartbeat failed: {e}")
+                if time.monotonic() - renewed_at < self.lease_seconds:
+                    continue
+                print(f"[job {job.job_id}] lease could not be renewed in time")
+            lost.set()
+            automation.cancelled.set()
+            run_task.cancel()
+            return
+    
+    async def _run_job(self, browser, job):
+        from work_queue import LeaseLost
+        
+        label = f"[job {job.job_id} {job.account} {job.start_date} .. {job.end_date}]"
+        print(f"\n{label} attempt {job.attempts}")
+        if job.account != 'default' and job.account not in self.accounts:
+            await asyncio.to_thread(self.queue.fail, job, f"Unknown account {job.account}", 1)
+            print(f"{label} unknown account, parked as failed")
+            return
+        
+        automation = None
+        context = None
+        heartbeat = None
+        lost = asyncio.Event()
+        try:
+            automation = WaterReportAutomation(self.accounts.get(job.account))
+            automation.fixed_date_range = (job.start_date, job.end_date)
+            automation.work_queue = self.queue
+            automation.work_job = job
+            
+            context = await automation.new_portal_context(browser)
+            run_task = asyncio.create_task(automation.run(context=context, notify=False))
+            heartbeat = asyncio.create_task(self._heartbeat(job, lost, run_task, automation))
+            try:
+                await run_task
+            except asyncio.CancelledError:
+                if not lost.is_set():
+                    raise  # The worker itself is being cancelled
+            
+            if lost.is_set():
+                outcome = "lease lost, run stopped"
+            elif automation.errors:
+                outcome = await asyncio.to_thread(
+                    self.queue.fail, job, '; '.join(automation.errors), self.max_attempts
+                )
+            else:
+                await asyncio.to_thread(self.queue.complete, job)
+                outcome = "done"
+        except LeaseLost:
+            outcome = "lease lost"
+        except Exception as e:
+            print(f"{label} failed: {e}")
+            try:
+                outcome = await asyncio.to_thread(self.queue.fail, job, str(e), self.max_attempts)
+            except Exception as fail_error:
+                outcome = f"failed, could not release the job ({fail_error})"
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            if context is not None:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+            if automation is not None:
+                automation.close()
+        
+        print(f"{label} {outcome}")
+        self.results.append({
+            'job_id': job.job_id,
+            'account': job.account,
+            'window': (job.start_date, job.end_date),
+            'uploaded': len(automation.uploaded_files) if automation else 0,
+            'outcome': outcome
+        })
+    
+    async def run(self):
+        async with async_playwright() as p:
+            browser = await launch_browser(p)
+            try:
+                while True:
+                    job = await asyncio.to_thread(
+                        self.queue.lease, self.worker_id, self.lease_seconds, self.max_attempts
+                    )
+                    if job is None:
+                        if not self.wait:
+                            break
+                        await asyncio.sleep(self.idle_seconds)
+                        continue
+                    await self._run_job(browser, job)
+            finally:
+                await browser.close()
+        
+        print()
         print("=" * 60)
+        print(f"Worker {self.worker_id}: {len(self.results)} job(s)")
+        for result in self.results:
+            print(f"  job {result['job_id']} {result['account']} {result['window'][0]} .. {result['window'][1]}: "
+                  f"{result['outcome']}, {result['uploaded']} uploaded")
+        print(f"Queue: {self.queue.counts()}")
+        print("=" * 60)
+        return self.results
+
+
+class AutomationDaemon:
+    """Long-running mode: one warm browser and authenticated context, runs on a schedule
+    
+    Each scheduled run gets a fresh WaterReportAutomation (so per-run results
+    never leak between runs) but reuses the browser and portal context. The
+    browser is recycled after DAEMON_RECYCLE_RUNS runs, when the browser's
+    memory passes DAEMON_RECYCLE_MEMORY_MB, or after a run that failed.
+    
+    In polling mode every run looks at today's grid, only acts on rows that
+    changed since the last poll, and results are emailed as one digest every
+    digest_minutes instead of once per poll.
+    """
+    
+    def __init__(self, run_times=None, interval_minutes=None, recycle_runs=20, recycle_memory_mb=1500,
+                 run_on_start=False, poll=False, digest_minutes=0):
+        self.run_times = sorted(run_times or [])  # Daily (hour, minute) tuples
+        self.interval = timedelta(minutes=interval_minutes) if interval_minutes else None
+        if not self.run_times and not self.interval:
+            raise ValueError("Daemon needs DAEMON_SCHEDULE times or DAEMON_INTERVAL_MINUTES")
+        self.recycle_runs = recycle_runs
+        self.recycle_memory_mb = recycle_memory_mb
+        self.run_on_start = run_on_start
+        self.playwright = None
+        self.browser = None
+        self.context = None
+        self.context_owner = None  # Automation whose profile/session opened the warm context
+        self.landing_url = None  # Last authenticated portal page seen in the warm context
+        self.runs_since_launch = 0
+        self.last_start = None
+        self.poll_state = GridPollState() if poll else None
+        self.digest_interval = timedelta(minutes=digest_minutes)
+        self.digest = None  # Results accumulated since the last digest email
+        self.digest_started = None
+        self._stop = asyncio.Event()
+    
+    @classmethod
+    def from_env(cls, poll=False):
+        if poll:
+            return cls(
+                interval_minutes=int(os.getenv('POLL_INTERVAL_MINUTES', '15')),
+                recycle_runs=int(os.getenv('DAEMON_RECYCLE_RUNS', '20')),
+                recycle_memory_mb=int(os.getenv('DAEMON_RECYCLE_MEMORY_MB', '1500')),
+                run_on_start=True,
+                poll=True,
+                digest_minutes=int(os.getenv('POLL_DIGEST_MINUTES', '240'))
+            )
+        
+        run_times = []
+        for value in os.getenv('DAEMON_SCHEDULE', '').split(','):
+            if value.strip():
+                hour, minute = value.strip().split(':')
+                run_times.append((int(hour), int(minute)))
+        interval = os.getenv('DAEMON_INTERVAL_MINUTES')
+        return cls(
+            run_times=run_times,
+            interval_minutes=int(interval) if interval else None,
+            recycle_runs=int(os.getenv('DAEMON_RECYCLE_RUNS', '20')),
+            recycle_memory_mb=int(os.getenv('DAEMON_RECYCLE_MEMORY_MB', '1500')),
+            run_on_start=os.getenv('DAEMON_RUN_ON_START', 'false').lower() == 'true'
+        )
+    
+    def next_run_time(self, now):
+        """When the next scheduled run is due"""
+        if self.interval:
+            if self.last_start is None:
+                return now if self.run_on_start else now + self.interval
+            due = self.last_start + self.interval
+            if due < now:
+                # The last run overran the interval: skip the slots it missed instead of
+                # running them back to back
+                due += ((now - due) // self.interval + 1) * self.interval
+            return due
+        
+        if self.last_start is None and self.run_on_start:
+            return now
+        for hour, minute in self.run_times:
+            candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if candidate > now:
+                return candidate
+        hour, minute = self.run_times[0]
+        return (now + timedelta(days=1)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    
+    async def _start_browser(self):
+        self.context_owner = WaterReportAutomation()
+        self.browser = await self.context_owner.launch_browser(self.playwright)
+        self.context = await self.context_owner.new_portal_context(self.browser)
+        saved = self.context_owner.saved_session
+        self.landing_url = saved.get('landing_url') if saved else None
+        self.runs_since_launch = 0
+        print(f"Warm browser started ({self.context_owner.browser_profile} profile)")
+    
+    async def _stop_browser(self):
+        if self.browser is not None:
+            try:
+                await self.browser.close()
+            except Exception as e:
+                print(f"Warning: could not close browser cleanly: {e}")
+        if self.context_owner is not None:
+            self.context_owner.close()
+        self.browser = self.context = self.context_owner = None
+    
+    def browser_memory_mb(self):
+        """Resident memory of the browser processes (children of this process), or None"""
+        try:
+            import psutil
+        except ImportError:
+            return None
+        total = 0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                continue
+        return total / (1024 * 1024)
+    
+    async def run_once(self):
+        """One scheduled run in the warm context, then decide whether to recycle"""
+        if self.browser is None or not self.browser.is_connected():
+            await self._stop_browser()
+            await self._start_browser()
+        
+        automation = WaterReportAutomation()
+        # The warm context is still logged in: go straight to the last portal page
+        automation.warm_landing_url = self.landing_url
+        if self.poll_state:
+            automation.include_today = True
+            automation.poll_state = self.poll_state
+        try:
+            await automation.run(context=self.context, notify=not self.poll_state)
+        finally:
+            automation.close()
+        self.landing_url = automation.landing_url or automation.warm_landing_url
+        self.runs_since_launch += 1
+        
+        if self.poll_state:
+            if not automation.errors and automation.grid_rows:
+                # Failed polls keep the old state, so their rows are retried next time
+                self.poll_state.update(automation.grid_rows)
+            self._add_to_digest(automation)
+            if datetime.now() - self.digest_started >= self.digest_interval:
+                self.send_digest()
+        
+        memory_mb = self.browser_memory_mb()
+        reason = None
+        if automation.errors:
+            reason = "run reported errors"
+        elif self.runs_since_launch >= self.recycle_runs:
+            reason = f"{self.runs_since_launch} runs"
+        elif memory_mb is not None and memory_mb >= self.recycle_memory_mb:
+            reason = f"browser memory at {memory_mb:.0f} MB"
+        if reason:
+            print(f"Recycling browser ({reason})")
+            await self._stop_browser()
+    
+    def _add_to_digest(self, automation):
+        if self.digest is None:
+            self.digest = {'downloaded': [], 'uploaded': [], 'urls': {}, 'skipped': [], 'errors': []}
+            self.digest_started = datetime.now()
+        stamp = datetime.now().strftime('%H:%M')
+        self.digest['downloaded'].extend(automation.downloaded_files)
+        self.digest['uploaded'].extend(automation.uploaded_files)
+        self.digest['urls'].update(automation.uploaded_files_urls)
+        self.digest['skipped'].extend(automation.skipped_files)
+        self.digest['errors'].extend(f"[{stamp}] {error}" for error in automation.errors)
+    
+    def send_digest(self):
+        """Email everything collected since the last digest; polls that found nothing send nothing"""
+        digest, self.digest = self.digest, None
+        if not digest or not (digest['downloaded'] or digest['errors']):
+            return
+        reporter = WaterReportAutomation()
+        try:
+            reporter.downloaded_files = digest['downloaded']
+            reporter.uploaded_files = digest['uploaded']
+            reporter.uploaded_files_urls = digest['urls']
+            reporter.skipped_files = digest['skipped']
+            reporter.errors = digest['errors']
+            print(f"Sending digest: {len(digest['downloaded'])} report(s), {len(digest['errors'])} error(s)")
+            reporter.send_notification_email()
+        finally:
+            reporter.close()
+    
+    def stop(self):
+        self._stop.set()
+    
+    async def serve(self):
+        """Run until stopped (Ctrl+C or SIGTERM)"""
+        import signal
+        
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C still ends asyncio.run
+        
+        async with async_playwright() as playwright:
+            self.playwright = playwright
+            try:
+                await self._start_browser()
+                while not self._stop.is_set():
+                    now = datetime.now()
+                    due = self.next_run_time(now)
+                    print(f"Next run at {due.strftime('%Y-%m-%d %H:%M:%S')}")
+                    try:
+                        await asyncio.wait_for(self._stop.wait(), timeout=max((due - now).total_seconds(), 0))
+                        break  # Stopped while waiting
+                    except asyncio.TimeoutError:
+                        pass
+                    
+                    self.last_start = due
+                    try:
+                        await self.run_once()
+                    except Exception as e:
+                        print(f"Daemon run failed: {e}")
+                        await self._stop_browser()
+            finally:
+                await self._stop_browser()
+                self.playwright = None
+        if self.poll_state:
+            # Don't lose results that were waiting for the next digest
+            self.send_digest()
+        print("Daemon stopped")
 
 
 def main():
     """Entry point"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Meras Water Report Automation")
+    parser.add_argument('--backfill', nargs=2, metavar=('START', 'END'),
+                        help="Re-pull reports between two dates (YYYY-MM-DD) in parallel weekly windows")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep a warm browser and run on DAEMON_SCHEDULE / DAEMON_INTERVAL_MINUTES")
+    parser.add_argument('--poll', action='store_true',
+                        help="Check today's grid every POLL_INTERVAL_MINUTES and email a digest every POLL_DIGEST_MINUTES")
+    parser.add_argument('--accounts', metavar='FILE',
+                        help="JSON file of account profiles: runs them all concurrently, or names the accounts for --enqueue/--worker")
+    parser.add_argument('--enqueue', nargs=2, metavar=('START', 'END'),
+                        help="Add backfill jobs (per account and BACKFILL_WINDOW_DAYS window) to the work queue")
+    parser.add_argument('--worker', action='store_true',
+                        help="Run jobs from the work queue (WORK_QUEUE_URL) until it is empty")
+    parser.add_argument('--debug-browser', action='store_true',
+                        help="Use the headed system Chrome profile (same as BROWSER_PROFILE=debug)")
+    args = parser.parse_args()
+    
+    if args.debug_browser:
+        os.environ['BROWSER_PROFILE'] = 'debug'
+    
+    accounts = []
+    if args.accounts:
+        try:
+            accounts = AccountProfile.load_all(args.accounts)
+        except (OSError, ValueError) as e:
+            parser.error(f"Invalid accounts file: {e}")
+    
+    if args.enqueue or args.worker:
+        from work_queue import open_work_queue
+        
+        queue = open_work_queue()
+        try:
+            if args.enqueue:
+                windows = WaterReportAutomation._backfill_windows(
+                    *args.enqueue, int(os.getenv('BACKFILL_WINDOW_DAYS', '7'))
+                )
+                for name in [account.name for account in accounts] or ['default']:
+                    added = queue.enqueue(name, windows)
+                    print(f"{name}: {added} job(s) added ({len(windows) - added} already queued)")
+            if args.worker:
+                worker = QueueWorker(
+                    queue, accounts,
+                    lease_seconds=int(os.getenv('WORK_LEASE_SECONDS', '300')),
+                    max_attempts=int(os.getenv('WORK_MAX_ATTEMPTS', '3')),
+                    wait=os.getenv('WORKER_WAIT_FOR_JOBS', 'false').lower() == 'true'
+                )
+                asyncio.run(worker.run())
+        finally:
+            queue.close()
+        return
+    
+    if args.accounts:
+        runner = MultiAccountRunner(
+            accounts,
+            max_concurrency=int(os.getenv('ACCOUNTS_MAX_CONCURRENCY', '2'))
+        )
+        asyncio.run(runner.run())
+        return
+    
+    if args.daemon or args.poll:
+        asyncio.run(AutomationDaemon.from_env(poll=args.poll).serve())
+        return
+    
     automation = WaterReportAutomation()
-    asyncio.run(automation.run())
+    asyncio.run(automation.run(backfill=tuple(args.backfill) if args.backfill else None))
 
 
 if __name__ == "__main__":
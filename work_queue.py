@@ -0,0 +1,299 @@
+"""
+Work queue for splitting backfills and accounts across several workers
+Jobs are (account, date window) pairs. A worker leases one job at a time and
+keeps the lease alive with heartbeats; a lease that is not renewed expires and
+the job goes back to the queue. Reports are claimed per account before they
+are downloaded and marked uploaded once they are in SharePoint, so a report is
+uploaded by exactly one worker even when windows are re-run.
+
+The SQLite backend works for every worker on one host (SQLite's file locking
+serialises them). Other backends implement WorkQueue and are selected with
+WORK_QUEUE_BACKEND=package.module:ClassName.
+"""
+
+import importlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass
+class Job:
+    """One leased unit of work"""
+    job_id: int
+    account: str
+    start_date: str
+    end_date: str
+    attempts: int
+    lease_token: str
+
+
+class LeaseLost(Exception):
+    """Raised when a worker no longer holds the lease it is acting on"""
+
+
+class WorkQueue(ABC):
+    """Interface every work queue backend implements"""
+
+    @abstractmethod
+    def enqueue(self, account, windows):
+        """Add a job per (start, end) window; existing jobs are left alone. Returns the number added"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def lease(self, worker_id, lease_seconds, max_attempts):
+        """Lease the next pending (or expired) job, or return None if there is nothing to do
+
+        Expired jobs that already used max_attempts are parked as failed instead.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def heartbeat(self, job, lease_seconds):
+        """Extend the job's lease and its report claims; False if the lease was lost"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def complete(self, job):
+        """Mark the job done; raises LeaseLost if another worker has taken it over"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def fail(self, job, error, max_attempts):
+        """Release the job for a retry, or park it as failed after max_attempts"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_reports(self, job, report_ids):
+        """Claim reports for the job; returns the ids this worker may download and upload"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def mark_reports_uploaded(self, job, report_ids):
+        """Record reports as uploaded; they are never handed out again
+
+        Raises LeaseLost (and records nothing) if any of the claims is no longer held.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def counts(self):
+        """Job counts by state"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """Work queue in a SQLite file shared by the workers on one host"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode: every write below runs in an explicit BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " account TEXT NOT NULL,"
+            " start_date TEXT NOT NULL,"
+            " end_date TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " worker TEXT,"
+            " lease_token TEXT,"
+            " lease_expires REAL,"
+            " last_error TEXT,"
+            " UNIQUE (account, start_date, end_date))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS report_claims ("
+            " account TEXT NOT NULL,"
+            " report_id TEXT NOT NULL,"
+            " lease_token TEXT,"
+            " lease_expires REAL,"
+            " uploaded INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (account, report_id))"
+        )
+
+    def _write(self, statements):
+        """Run a function of the connection inside one BEGIN IMMEDIATE transaction"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.conn)
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, account, windows):
+        def insert(conn):
+            added = 0
+            for start_date, end_date in windows:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO jobs (account, start_date, end_date) VALUES (?, ?, ?)",
+                    (account, start_date, end_date)
+                )
+                added += cursor.rowcount
+            return added
+        return self._write(insert)
+
+    def lease(self, worker_id, lease_seconds, max_attempts):
+        def take(conn):
+            now = time.time()
+            # A job whose worker died on every attempt is not handed out again
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', lease_token = NULL, lease_expires = NULL,"
+                " last_error = 'Lease expired on the last attempt'"
+                " WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, max_attempts)
+            )
+            conn.execute(
+                "UPDATE report_claims SET lease_token = NULL, lease_expires = NULL"
+                " WHERE uploaded = 0 AND lease_expires < ?",
+                (now,)
+            )
+            row = conn.execute(
+                "SELECT job_id, account, start_date, end_date, attempts FROM jobs"
+                " WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)"
+                " ORDER BY start_date, job_id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, account, start_date, end_date, attempts = row
+            token = f"{worker_id}:{job_id}:{now:.6f}"
+            conn.execute(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_token = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE job_id = ?",
+                (worker_id, token, now + lease_seconds, job_id)
+            )
+            return Job(job_id, account, start_date, end_date, attempts + 1, token)
+        return self._write(take)
+
+    def heartbeat(self, job, lease_seconds):
+        def extend(conn):
+            expires = time.time() + lease_seconds
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND lease_token = ? AND state = 'leased'",
+                (expires, job.job_id, job.lease_token)
+            )
+            if cursor.rowcount == 0:
+                return False
+            conn.execute(
+                "UPDATE report_claims SET lease_expires = ? WHERE lease_token = ? AND uploaded = 0",
+                (expires, job.lease_token)
+            )
+            return True
+        return self._write(extend)
+
+    def complete(self, job):
+        def finish(conn):
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'done', lease_expires = NULL, last_error = NULL"
+                " WHERE job_id = ? AND lease_token = ?",
+                (job.job_id, job.lease_token)
+            )
+            if cursor.rowcount == 0:
+                raise LeaseLost(f"Job {job.job_id} was taken over by another worker")
+        self._write(finish)
+
+    def fail(self, job, error, max_attempts):
+        def release(conn):
+            state = 'failed' if job.attempts >= max_attempts else 'pending'
+            conn.execute(
+                "UPDATE jobs SET state = ?, lease_token = NULL, lease_expires = NULL, last_error = ?"
+                " WHERE job_id = ? AND lease_token = ?",
+                (state, error, job.job_id, job.lease_token)
+            )
+            # Claims of the failed attempt are free for the retry
+            conn.execute(
+                "UPDATE report_claims SET lease_token = NULL, lease_expires = NULL"
+                " WHERE lease_token = ? AND uploaded = 0",
+                (job.lease_token,)
+            )
+            return state
+        return self._write(release)
+
+    def claim_reports(self, job, report_ids):
+        def claim(conn):
+            now = time.time()
+            lease_expires = conn.execute(
+                "SELECT lease_expires FROM jobs WHERE job_id = ? AND lease_token = ?",
+                (job.job_id, job.lease_token)
+            ).fetchone()
+            if lease_expires is None:
+                raise LeaseLost(f"Job {job.job_id} was taken over by another worker")
+            claimed = set()
+            for report_id in report_ids:
+                conn.execute(
+                    "INSERT OR IGNORE INTO report_claims (account, report_id) VALUES (?, ?)",
+                    (job.account, report_id)
+                )
+                cursor = conn.execute(
+                    "UPDATE report_claims SET lease_token = ?, lease_expires = ?"
+                    " WHERE account = ? AND report_id = ? AND uploaded = 0"
+                    " AND (lease_token IS NULL OR lease_token = ? OR lease_expires < ?)",
+                    (job.lease_token, lease_expires[0], job.account, report_id, job.lease_token, now)
+                )
+                if cursor.rowcount:
+                    claimed.add(report_id)
+            return claimed
+        return self._write(claim)
+
+    def mark_reports_uploaded(self, job, report_ids):
+        def mark(conn):
+            lost = []
+            for report_id in report_ids:
+                cursor = conn.execute(
+                    "UPDATE report_claims SET uploaded = 1, lease_expires = NULL"
+                    " WHERE account = ? AND report_id = ? AND lease_token = ?",
+                    (job.account, report_id, job.lease_token)
+                )
+                if cursor.rowcount == 0:
+                    lost.append(report_id)
+            if lost:
+                raise LeaseLost(f"Claims on {', '.join(lost)} were taken over by another worker")
+        self._write(mark)
+
+    def counts(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_work_queue(url=None):
+    """Open the queue named by url / WORK_QUEUE_URL
+
+    A sqlite:/// URL or a plain path opens the SQLite backend. Anything else is
+    passed to the class named by WORK_QUEUE_BACKEND (package.module:ClassName).
+    """
+    url = url or os.getenv('WORK_QUEUE_URL', './.state/work_queue.db')
+    backend = os.getenv('WORK_QUEUE_BACKEND')
+    if backend:
+        module_name, _, class_name = backend.partition(':')
+        queue_class = getattr(importlib.import_module(module_name), class_name)
+        return queue_class(url)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    elif '://' in url:
+        raise ValueError(f"No work queue backend for {url}; set WORK_QUEUE_BACKEND=package.module:ClassName")
+    return SQLiteWorkQueue(url)
+
+
+def worker_id():
+    """Identity of this worker process in leases"""
+    return f"{socket.gethostname()}:{os.getpid()}"